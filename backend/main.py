@@ -1,17 +1,39 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from groq import Groq
+from groq import BadRequestError, Groq
 from dotenv import load_dotenv
 import os
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+import ast
+import asyncio
+import codecs
+import difflib
+import hashlib
+import heapq
 import json
+import math
+import pstats
+import queue
 import re
+import shutil
+import signal
+import sqlite3
 import subprocess
+import sys
 import tempfile
+import time
 import uuid
 from pydantic import BaseModel
 from firebase_config import db
+from firebase_admin import auth as firebase_auth, firestore
 from datetime import datetime
+from typing import Optional
+from threading import Event, Lock, Thread
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 load_dotenv()
@@ -65,11 +87,1223 @@ def parse_review_response(review_text: str):
     }
 
 
+REVIEW_SECTIONS = ["Critical Issues", "High Priority", "Medium Priority", "Low Priority"]
+
+
+def has_all_review_sections(review_text: str):
+    return all(re.search(rf"## .*{title}", review_text) for title in REVIEW_SECTIONS)
+
+
+# ================================
+# ADMISSION CONTROL
+# ================================
+
+# Per request class: token bucket (rate per minute, burst) applied per
+# user, plus a shared pool of concurrent slots handed out by weighted
+# fair queueing
+ADMISSION_CLASSES = {
+    "llm": {
+        "rate_per_minute": float(os.getenv("LLM_RATE_PER_MINUTE", "30")),
+        "burst": float(os.getenv("LLM_BURST", "10")),
+        "concurrency": int(os.getenv("LLM_CONCURRENCY", "8")),
+    },
+    "run": {
+        "rate_per_minute": float(os.getenv("RUN_RATE_PER_MINUTE", "20")),
+        "burst": float(os.getenv("RUN_BURST", "5")),
+        "concurrency": int(os.getenv("RUN_CONCURRENCY", "4")),
+    },
+}
+
+# Per-user overrides, e.g. {"<uid>": {"weight": 2, "llm": {"rate_per_minute": 120}}}
+USER_QUOTAS = json.loads(os.getenv("USER_QUOTAS", "{}"))
+
+MAX_QUEUE_WAIT = float(os.getenv("MAX_QUEUE_WAIT", "20"))
+
+# Per-user state is kept for at most this many users (least recently seen
+# are dropped first); idle buckets are swept every BUCKET_SWEEP_SECONDS
+MAX_TRACKED_USERS = int(os.getenv("MAX_TRACKED_USERS", "10000"))
+BUCKET_SWEEP_SECONDS = 60
+
+current_user = ContextVar("current_user", default=None)
+
+
+class TokenBucket:
+
+    def __init__(self, rate_per_minute: float, burst: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token; returns 0 if admitted, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate if self.rate > 0 else MAX_QUEUE_WAIT
+
+    def is_full(self, now: float):
+        """A full bucket behaves like a new one, so it can be dropped."""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class FairQueue:
+    """
+    Hands out `slots` concurrent slots. When all are busy, waiters are
+    served in order of virtual finish time (start + 1/weight), so each
+    user gets a share of capacity proportional to their weight no matter
+    how many requests they queue.
+    """
+
+    def __init__(self, slots: int):
+        self.lock = Lock()
+        self.free = slots
+        self.slots = slots
+        self.waiting = []
+        self.sequence = 0
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.service_time = 1.0
+
+    def enqueue(self, user: str, weight: float, wake):
+        """
+        Take a free slot (returns None) or queue a waiter that `wake()` is
+        called for when release() grants it a slot (returns the waiter).
+        """
+        with self.lock:
+            if self.free > 0 and not self.waiting:
+                self.free -= 1
+                return None
+
+            finish = max(self.virtual_time, self.last_finish.get(user, 0.0)) + 1 / weight
+            self.last_finish[user] = finish
+            # Finish times already passed don't affect ordering
+            if len(self.last_finish) > MAX_TRACKED_USERS:
+                self.last_finish = {
+                    key: value for key, value in self.last_finish.items() if value > self.virtual_time
+                }
+            self.sequence += 1
+            waiter = {"wake": wake, "granted": False}
+            heapq.heappush(self.waiting, (finish, self.sequence, waiter))
+            return waiter
+
+    def settle(self, waiter):
+        """After a wait ends: True if granted, else drop the waiter from the queue."""
+        with self.lock:
+            if waiter["granted"]:
+                return True
+            self.waiting = [entry for entry in self.waiting if entry[2] is not waiter]
+            heapq.heapify(self.waiting)
+            return False
+
+    def acquire(self, user: str, weight: float, timeout: float):
+        """Blocking wait, for callers on their own thread (editor sessions)."""
+        granted = Event()
+        waiter = self.enqueue(user, weight, granted.set)
+        if waiter is None:
+            return True
+
+        granted.wait(timeout)
+        return self.settle(waiter)
+
+    async def acquire_async(self, user: str, weight: float, timeout: float):
+        """
+        Wait on the event loop. Parking HTTP waiters in the threadpool would
+        starve the sync endpoints they are queueing for of threads.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        waiter = self.enqueue(user, weight, wake)
+        if waiter is None:
+            return True
+
+        try:
+            await asyncio.wait_for(granted, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Client went away: hand back a slot granted in the meantime
+            if self.settle(waiter):
+                self.release(None)
+            raise
+
+        return self.settle(waiter)
+
+    def release(self, elapsed: Optional[float]):
+        with self.lock:
+            if elapsed is not None:
+                self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+
+            if self.waiting:
+                finish, _, waiter = heapq.heappop(self.waiting)
+                self.virtual_time = finish
+                waiter["granted"] = True
+                waiter["wake"]()
+            else:
+                self.free += 1
+
+    def retry_after(self):
+        with self.lock:
+            return len(self.waiting) * self.service_time / self.slots
+
+
+admission_lock = Lock()
+user_buckets = {}
+buckets_swept = time.monotonic()
+fair_queues = {kind: FairQueue(config["concurrency"]) for kind, config in ADMISSION_CLASSES.items()}
+user_usage = OrderedDict()
+
+
+def usage_for(user: str):
+    # Callers hold admission_lock
+    usage = user_usage.get(user)
+    if usage is not None:
+        user_usage.move_to_end(user)
+        return usage
+
+    usage = user_usage[user] = {
+        "requests": {kind: 0 for kind in ADMISSION_CLASSES},
+        "rejected": 0,
+        "llm_tokens": 0,
+        "busy_seconds": {kind: 0.0 for kind in ADMISSION_CLASSES},
+        "queue_wait_seconds": 0.0,
+    }
+    while len(user_usage) > MAX_TRACKED_USERS:
+        user_usage.popitem(last=False)
+    return usage
+
+
+def sweep_buckets(now: float):
+    # Callers hold admission_lock
+    global buckets_swept
+
+    if now - buckets_swept < BUCKET_SWEEP_SECONDS and len(user_buckets) <= MAX_TRACKED_USERS:
+        return
+
+    buckets_swept = now
+    for key in [key for key, bucket in user_buckets.items() if bucket.is_full(now)]:
+        del user_buckets[key]
+
+
+def record_user_tokens(usage):
+    user = current_user.get()
+    if user is None or usage is None:
+        return
+    with admission_lock:
+        usage_for(user)["llm_tokens"] += usage.prompt_tokens + usage.completion_tokens
+
+
+def verified_user(id_token: Optional[str]):
+    """
+    The uid of a Firebase ID token, or None when no token is given.
+    Anything else a client sends about who it is (headers, user_id fields)
+    can be changed per request, so only verified tokens name a user.
+    """
+    if not id_token:
+        return None
+
+    try:
+        return firebase_auth.verify_id_token(id_token)["uid"]
+    except Exception as e:
+        print("ID TOKEN REJECTED:", str(e))
+        raise HTTPException(status_code=401, detail="Invalid or expired ID token")
+
+
+async def caller_id(raw_request: Request):
+    authorization = raw_request.headers.get("authorization", "")
+    scheme, _, id_token = authorization.partition(" ")
+    uid = await run_in_threadpool(verified_user, id_token.strip() if scheme.lower() == "bearer" else None)
+    if uid is not None:
+        return uid
+
+    return f"ip:{raw_request.client.host if raw_request.client else 'unknown'}"
+
+
+def take_admission_token(user: str, kind: str):
+    """
+    Take a token from the user's bucket; raises HTTPException(429) when
+    it's empty. Returns the user's fair-share weight.
+    """
+    quota = USER_QUOTAS.get(user, {})
+    limits = {**ADMISSION_CLASSES[kind], **quota.get(kind, {})}
+
+    with admission_lock:
+        sweep_buckets(time.monotonic())
+        bucket = user_buckets.get((user, kind))
+        if bucket is None:
+            bucket = user_buckets[(user, kind)] = TokenBucket(limits["rate_per_minute"], limits["burst"])
+        retry_after = bucket.take()
+        if retry_after:
+            usage_for(user)["rejected"] += 1
+
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+    return float(quota.get("weight", 1))
+
+
+def finish_queueing(user: str, kind: str, queued: float, admitted: bool):
+    """Record the wait; raises HTTPException(429) if no slot came free."""
+    if not admitted:
+        with admission_lock:
+            usage_for(user)["rejected"] += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Server busy, try again shortly",
+            headers={"Retry-After": str(max(math.ceil(fair_queues[kind].retry_after()), 1))}
+        )
+
+    started = time.monotonic()
+
+    with admission_lock:
+        usage = usage_for(user)
+        usage["requests"][kind] += 1
+        usage["queue_wait_seconds"] += started - queued
+
+    return started
+
+
+def enter_admission(user: str, kind: str):
+    """
+    Take a token from the user's bucket and wait for a fair-share slot.
+    Blocks while queued; raises HTTPException(429) when rejected.
+    Returns the start time to pass to exit_admission.
+    """
+    weight = take_admission_token(user, kind)
+    queued = time.monotonic()
+    admitted = fair_queues[kind].acquire(user, weight, MAX_QUEUE_WAIT)
+    return finish_queueing(user, kind, queued, admitted)
+
+
+async def enter_admission_async(user: str, kind: str):
+    """enter_admission for the event loop: queues without holding a thread."""
+    weight = take_admission_token(user, kind)
+    queued = time.monotonic()
+    admitted = await fair_queues[kind].acquire_async(user, weight, MAX_QUEUE_WAIT)
+    return finish_queueing(user, kind, queued, admitted)
+
+
+def exit_admission(user: str, kind: str, started: float):
+    elapsed = time.monotonic() - started
+    fair_queues[kind].release(elapsed)
+
+    with admission_lock:
+        usage_for(user)["busy_seconds"][kind] += elapsed
+
+
+def admission(kind: str):
+    """Dependency enforcing the per-user quota and fair share for `kind`."""
+
+    async def admit(raw_request: Request):
+        user = await caller_id(raw_request)
+        started = await enter_admission_async(user, kind)
+        current_user.set(user)
+
+        try:
+            yield user
+        finally:
+            exit_admission(user, kind, started)
+
+    return admit
+
+
+admit_llm = admission("llm")
+admit_run = admission("run")
+
+
+@app.get("/usage")
+def get_usage():
+
+    with admission_lock:
+        users = json.loads(json.dumps(user_usage))
+
+    return {
+        "limits": ADMISSION_CLASSES,
+        "queued": {kind: len(fair_queue.waiting) for kind, fair_queue in fair_queues.items()},
+        "users": users
+    }
+
+
+@app.get("/usage/{user_id}")
+def get_user_usage(user_id: str):
+
+    with admission_lock:
+        if user_id not in user_usage:
+            raise HTTPException(status_code=404, detail="No usage recorded for this user")
+        return json.loads(json.dumps(user_usage[user_id]))
+
+
+# ================================
+# MODEL ROUTING
+# ================================
+
+SMALL_MODEL = "llama-3.1-8b-instant"
+LARGE_MODEL = "llama-3.3-70b-versatile"
+
+# USD per 1M tokens: (input, output)
+MODEL_PRICING = {
+    SMALL_MODEL: (0.05, 0.08),
+    LARGE_MODEL: (0.59, 0.79),
+}
+
+# Per task:
+# - small_max_chars: inputs up to this size start on the small model (0 = always large)
+# - cascade: escalate to the large model when the small model's output fails validation
+MODEL_ROUTES = {
+    "validate":   {"small_max_chars": 8000, "cascade": True},
+    "review":     {"small_max_chars": 2500, "cascade": True},
+    "optimize":   {"small_max_chars": 1500, "cascade": True},
+    "edge_cases": {"small_max_chars": 2500, "cascade": True},
+    "comment":    {"small_max_chars": 1500, "cascade": False},
+    "rewrite":    {"small_max_chars": 1500, "cascade": False},
+    "debug":      {"small_max_chars": 0, "cascade": False},
+    "convert":    {"small_max_chars": 0, "cascade": False},
+    "generate":   {"small_max_chars": 0, "cascade": False},
+    "explain":    {"small_max_chars": 0, "cascade": False},
+    "summary":    {"small_max_chars": 100000, "cascade": False},
+    "docs":       {"small_max_chars": 100000, "cascade": False},
+    "input_generator": {"small_max_chars": 0, "cascade": False},
+}
+
+ROUTING_ENABLED = os.getenv("MODEL_ROUTING", "on").lower() != "off"
+
+routing_lock = Lock()
+routing_stats = {}
+
+
+def route_models(task: str, input_text: str = ""):
+    """Return the models to try for a task, in order."""
+    route = MODEL_ROUTES.get(task, {"small_max_chars": 0, "cascade": False})
+
+    if not ROUTING_ENABLED or len(input_text) > route["small_max_chars"]:
+        return [LARGE_MODEL]
+
+    if route["cascade"]:
+        return [SMALL_MODEL, LARGE_MODEL]
+
+    return [SMALL_MODEL]
+
+
+def usage_cost(model: str, usage):
+    if usage is None:
+        return 0.0
+    input_price, output_price = MODEL_PRICING.get(model, MODEL_PRICING[LARGE_MODEL])
+    return (usage.prompt_tokens * input_price + usage.completion_tokens * output_price) / 1_000_000
+
+
+def record_route(task: str, model: str, usage, escalated: bool):
+    cost = usage_cost(model, usage)
+    baseline = usage_cost(LARGE_MODEL, usage)
+    record_user_tokens(usage)
+
+    with routing_lock:
+        stats = routing_stats.setdefault(task, {
+            "calls": {SMALL_MODEL: 0, LARGE_MODEL: 0},
+            "escalations": 0,
+            "cost_usd": 0.0,
+            "large_only_cost_usd": 0.0,
+        })
+        stats["calls"][model] = stats["calls"].get(model, 0) + 1
+        stats["escalations"] += int(escalated)
+        stats["cost_usd"] += cost
+        # Only first-attempt calls count towards the large-only baseline,
+        # so escalations show up as extra cost
+        if not escalated:
+            stats["large_only_cost_usd"] += baseline
+
+
+CONTINUATION_TOKEN_BUDGET = int(os.getenv("CONTINUATION_TOKEN_BUDGET", "6000"))
+
+CONTINUE_PROMPT = (
+    "Your previous answer was cut off. Continue exactly where it stopped. "
+    "Do not repeat anything already written, do not add commentary or markdown."
+)
+
+MIN_STITCH_OVERLAP = 20
+
+
+def stitch_continuation(text: str, continuation: str):
+    """Append a continuation, dropping any fence or text the model repeated."""
+    if continuation.lstrip().startswith("```"):
+        continuation = continuation.lstrip().split("\n", 1)[1] if "\n" in continuation.lstrip() else ""
+
+    for size in range(min(len(text), len(continuation), 500), 3, -1):
+        if not text.endswith(continuation[:size]):
+            continue
+        # Short overlaps only count when the model restarted a whole line
+        starts_line = size == len(text) or text[-size - 1] == "\n"
+        if size >= MIN_STITCH_OVERLAP or starts_line:
+            return text + continuation[size:]
+
+    return text + continuation
+
+
+def failed_generation(error: BadRequestError):
+    """
+    The output Groq rejected in json_object mode (json_validate_failed),
+    or None for any other bad request.
+    """
+    body = error.body
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        body = body["error"]
+
+    if not isinstance(body, dict) or body.get("code") != "json_validate_failed":
+        return None
+
+    return body.get("failed_generation") or ""
+
+
+def complete(task: str, model: str, prompt: str, continuation_budget: int = 0, escalated: bool = False, **params):
+    """
+    One completion on `model`. If the model stops at max_tokens and a
+    continuation budget is given, ask it to continue and stitch the parts
+    together until it finishes or the total output reaches the budget.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    text = ""
+    used = 0
+
+    while True:
+        try:
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                **params
+            )
+        except BadRequestError as e:
+            failed = failed_generation(e)
+            if failed is None:
+                raise
+            # Hand the rejected output back so repair_json (or the cascade's
+            # validation) gets a chance at it instead of failing the request
+            print(f"JSON MODE {task}: {model} output rejected by the API, returning it for repair")
+            return stitch_continuation(text, failed)
+
+        record_route(task, model, response.usage, escalated)
+
+        text = stitch_continuation(text, response.choices[0].message.content or "")
+        used += response.usage.completion_tokens if response.usage else params.get("max_tokens", 0)
+
+        remaining = continuation_budget - used
+        if response.choices[0].finish_reason != "length" or remaining <= 0:
+            return text
+
+        print(f"CONTINUE {task}: output truncated after {used} tokens, continuing")
+        messages = [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": text},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+        params["max_tokens"] = min(params.get("max_tokens", remaining), remaining)
+
+
+class SingleFlight:
+    """
+    Collapses identical concurrent calls: the first caller for a key runs
+    the function, callers arriving while it runs wait and share its result.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.stats = {}
+
+    def do(self, key: str, task: str, fn):
+        with self.lock:
+            stats = self.stats.setdefault(task, {"upstream_calls": 0, "shared_calls": 0})
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = {"event": Event(), "result": None, "error": None}
+                stats["upstream_calls"] += 1
+            else:
+                stats["shared_calls"] += 1
+
+        if not is_leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["event"].set()
+
+
+llm_flights = SingleFlight()
+
+
+def call_llm(task: str, prompt: str, input_text: str = "", validate=None, continuation_budget: int = 0, **params):
+    """
+    Run a completion for `task` on the model picked by MODEL_ROUTES.
+
+    When the route cascades, the small model is tried first and the
+    large model is only called if `validate(output)` fails. Truncated
+    output is continued up to `continuation_budget` total tokens.
+
+    Identical calls already in flight share one upstream request.
+    """
+    key = hashlib.sha256(json.dumps({
+        "task": task,
+        "prompt": prompt,
+        "models": route_models(task, input_text),
+        "continuation_budget": continuation_budget,
+        "params": params,
+    }, sort_keys=True, default=str).encode()).hexdigest()
+
+    return llm_flights.do(
+        key,
+        task,
+        lambda: route_and_complete(task, prompt, input_text, validate, continuation_budget, **params)
+    )
+
+
+def route_and_complete(task: str, prompt: str, input_text: str, validate, continuation_budget: int, **params):
+    models = route_models(task, input_text)
+
+    for attempt, model in enumerate(models):
+        text = complete(task, model, prompt, continuation_budget, escalated=attempt > 0, **params)
+
+        is_last = attempt == len(models) - 1
+        if validate is None or is_last or validate(text):
+            print(f"ROUTE {task}: {model} ({len(input_text)} chars, attempt {attempt + 1})")
+            return text
+
+        print(f"ROUTE {task}: {model} output failed validation, escalating")
+
+    return text
+
+
+def stream_llm(task: str, prompt: str, input_text: str = "", operation=None, continuation_budget: int = 0,
+               model: Optional[str] = None, escalated: bool = False, **params):
+    """
+    Stream a completion for `task` as text chunks.
+
+    Streams can't be validated before they reach the client, so only the
+    first routed model is used unless `model` is given; callers escalate
+    themselves. Output cut off at max_tokens is continued up to
+    `continuation_budget` total tokens. Cancelling `operation` closes the
+    upstream stream.
+    """
+    model = model or route_models(task, input_text)[0]
+    print(f"ROUTE {task}: {model} ({len(input_text)} chars, streaming)")
+
+    messages = [{"role": "user", "content": prompt}]
+    text = ""
+    used = 0
+
+    while True:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **params
+        )
+
+        if operation is not None:
+            operation.on_cancel(stream.close)
+
+        usage = None
+        finish_reason = None
+        continuation = ""
+        try:
+            for chunk in stream:
+                if operation is not None and operation.cancelled.is_set():
+                    break
+
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    usage = x_groq.usage
+
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                content = chunk.choices[0].delta.content
+                if not content:
+                    continue
+
+                if messages[1:]:
+                    # Continuations may repeat the tail; stitch before yielding
+                    continuation += content
+                else:
+                    text += content
+                    yield content
+        except Exception:
+            # Closing the stream from another thread surfaces as a read error
+            if operation is None or not operation.cancelled.is_set():
+                raise
+        finally:
+            stream.close()
+
+        record_route(task, model, usage, escalated)
+
+        if continuation:
+            stitched = stitch_continuation(text, continuation)
+            if len(stitched) > len(text):
+                yield stitched[len(text):]
+            text = stitched
+
+        if operation is not None and operation.cancelled.is_set():
+            return
+
+        used += usage.completion_tokens if usage else params.get("max_tokens", 0)
+        remaining = continuation_budget - used
+        if finish_reason != "length" or remaining <= 0:
+            return
+
+        print(f"CONTINUE {task}: stream truncated after {used} tokens, continuing")
+        messages = [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": text},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+        params["max_tokens"] = min(params.get("max_tokens", remaining), remaining)
+
+
+@app.get("/singleflight/stats")
+def get_singleflight_stats():
+
+    with llm_flights.lock:
+        tasks = json.loads(json.dumps(llm_flights.stats))
+        in_flight = len(llm_flights.calls)
+
+    return {
+        "in_flight": in_flight,
+        "tasks": tasks,
+        "upstream_calls": sum(stats["upstream_calls"] for stats in tasks.values()),
+        "saved_calls": sum(stats["shared_calls"] for stats in tasks.values())
+    }
+
+
+@app.get("/routing/stats")
+def get_routing_stats():
+
+    with routing_lock:
+        tasks = json.loads(json.dumps(routing_stats))
+
+    total_cost = sum(stats["cost_usd"] for stats in tasks.values())
+    baseline_cost = sum(stats["large_only_cost_usd"] for stats in tasks.values())
+
+    return {
+        "enabled": ROUTING_ENABLED,
+        "routes": MODEL_ROUTES,
+        "tasks": tasks,
+        "cost_usd": round(total_cost, 6),
+        "large_only_cost_usd": round(baseline_cost, 6),
+        "saved_usd": round(baseline_cost - total_cost, 6),
+    }
+
+
+# ================================
+# PROMPT COMPACTION
+# ================================
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# tiktoken has no Llama 3 encoding; o200k_base is the closest vocabulary
+# size and is accurate to a few percent on code
+MODEL_ENCODINGS = {
+    SMALL_MODEL: "o200k_base",
+    LARGE_MODEL: "o200k_base",
+}
+
+# tiktoken downloads its vocabulary on first use; load it once here so a
+# server without network access falls back to the estimate instead of failing
+token_encodings = {}
+if tiktoken is not None:
+    try:
+        token_encodings = {name: tiktoken.get_encoding(name) for name in set(MODEL_ENCODINGS.values())}
+    except Exception as e:
+        print("TIKTOKEN UNAVAILABLE, estimating tokens:", e)
+        tiktoken = None
+
+# Comment and string syntax per language, used to strip comments safely
+LANGUAGE_SYNTAX = {
+    "python":     {"line": ["#"], "block": None, "strings": ['"""', "'''", '"', "'"]},
+    "ruby":       {"line": ["#"], "block": None, "strings": ['"', "'"]},
+    "sql":        {"line": ["--"], "block": ("/*", "*/"), "strings": ["'", '"']},
+    "php":        {"line": ["//", "#"], "block": ("/*", "*/"), "strings": ['"', "'"]},
+    "javascript": {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'", "`"]},
+    "typescript": {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'", "`"]},
+    "go":         {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'", "`"]},
+    "rust":       {"line": ["//"], "block": ("/*", "*/"), "strings": ['"']},
+    "swift":      {"line": ["//"], "block": ("/*", "*/"), "strings": ['"""', '"']},
+    "kotlin":     {"line": ["//"], "block": ("/*", "*/"), "strings": ['"""', '"', "'"]},
+    "java":       {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'"]},
+    "c":          {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'"]},
+    "cpp":        {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'"]},
+    "c#":         {"line": ["//"], "block": ("/*", "*/"), "strings": ['"', "'"]},
+}
+
+# Tasks whose answer doesn't depend on the user's comments
+STRIP_COMMENT_TASKS = {"optimize", "debug", "edge_cases"}
+
+# Tasks that refer to line numbers, so lines must not be merged or removed
+KEEP_LINE_TASKS = {"review"}
+
+# Output budget per task: max_tokens = base + ratio * input tokens, capped
+OUTPUT_BUDGETS = {
+    "review":     {"base": 400, "ratio": 0.5, "cap": 1500},
+    "rewrite":    {"base": 100, "ratio": 1.3, "cap": 4000},
+    "comment":    {"base": 150, "ratio": 1.6, "cap": 4000},
+    "convert":    {"base": 150, "ratio": 1.6, "cap": 4000},
+    "debug":      {"base": 300, "ratio": 1.4, "cap": 4000},
+    "optimize":   {"base": 350, "ratio": 1.4, "cap": 4000},
+    "edge_cases": {"base": 500, "ratio": 0.3, "cap": 1500},
+}
+
+prompt_stats_lock = Lock()
+prompt_stats = {}
+
+
+def count_tokens(text: str, model: str = LARGE_MODEL):
+    encoding = token_encodings.get(MODEL_ENCODINGS.get(model, "o200k_base"))
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Rough fallback: code averages ~4 characters per token
+    return math.ceil(len(text) / 4)
+
+
+def split_code(code: str, language: str):
+    """Split code into ("code" | "string" | "comment", text) segments."""
+    syntax = LANGUAGE_SYNTAX.get(language.lower())
+    if syntax is None:
+        return [("code", code)]
+
+    segments = []
+    start = 0
+    i = 0
+
+    def flush(end):
+        if end > start:
+            segments.append(("code", code[start:end]))
+
+    while i < len(code):
+        line_marker = next((marker for marker in syntax["line"] if code.startswith(marker, i)), None)
+        quote = next((quote for quote in syntax["strings"] if code.startswith(quote, i)), None)
+
+        if line_marker:
+            flush(i)
+            end = code.find("\n", i)
+            end = len(code) if end == -1 else end
+            segments.append(("comment", code[i:end]))
+            start = i = end
+
+        elif syntax["block"] and code.startswith(syntax["block"][0], i):
+            flush(i)
+            end = code.find(syntax["block"][1], i + len(syntax["block"][0]))
+            end = len(code) if end == -1 else end + len(syntax["block"][1])
+            segments.append(("comment", code[i:end]))
+            start = i = end
+
+        elif quote:
+            flush(i)
+            j = i + len(quote)
+            while j < len(code) and not code.startswith(quote, j):
+                # Single-line strings end at a newline even if unterminated
+                if code[j] == "\n" and len(quote) == 1 and quote != "`":
+                    break
+                j += 2 if code[j] == "\\" and quote != "`" else 1
+            end = min(j + len(quote), len(code)) if code.startswith(quote, j) else j
+            segments.append(("string", code[i:end]))
+            start = i = end
+
+        else:
+            i += 1
+
+    flush(len(code))
+    return segments
+
+
+def normalize_code(code: str, language: str, strip_comments: bool = False, keep_lines: bool = False):
+    """
+    Remove trailing whitespace and repeated blank lines, and optionally
+    comments. Text inside string literals is never changed.
+    """
+    if language.lower() not in LANGUAGE_SYNTAX:
+        return code
+
+    lines = [""]
+    protected = [False]
+
+    for kind, text in split_code(code, language):
+        if kind == "comment" and strip_comments:
+            # Keep the line breaks of block comments so nothing gets joined
+            text = "\n" * text.count("\n")
+
+        parts = text.split("\n")
+        lines[-1] += parts[0]
+        for part in parts[1:]:
+            # A line break inside a string: whitespace before it is part of the value
+            protected[-1] = kind == "string"
+            lines.append(part)
+            protected.append(False)
+
+    result = []
+    for line, is_protected in zip(lines, protected):
+        if not is_protected:
+            line = line.rstrip()
+        if not keep_lines and not line and result and not result[-1][0] and not result[-1][1]:
+            continue
+        result.append((line, is_protected))
+
+    text = "\n".join(line for line, _ in result)
+    return text if keep_lines else text.strip("\n")
+
+
+def compact_code(task: str, code: str, language: str, syntax=None):
+    """
+    Compact user code for a task's prompt and record the token savings.
+    Pass the original's check_syntax result as `syntax` if the caller
+    already has it.
+    """
+    strip_comments = task in STRIP_COMMENT_TASKS
+    keep_lines = task in KEEP_LINE_TASKS
+    normalized = normalize_code(code, language, False, keep_lines)
+    compacted = normalize_code(code, language, True, keep_lines) if strip_comments else normalized
+
+    # Never send something that parses worse than the original. Whitespace
+    # normalization is safe; only stripping comments needs a re-check, and
+    # without a checker (regex literals, multi-line strings containing "//")
+    # nothing would catch the damage, so comments are kept.
+    if compacted != normalized:
+        before = syntax or check_syntax(code, language)
+        if not before["checked"]:
+            compacted = normalized
+        elif before["valid"] and not check_syntax(compacted, language)["valid"]:
+            print(f"COMPACTION {task}: result failed syntax check, sending original")
+            compacted = code
+
+    raw_tokens = count_tokens(code)
+    compact_tokens = count_tokens(compacted)
+
+    with prompt_stats_lock:
+        stats = prompt_stats.setdefault(task, {"calls": 0, "raw_tokens": 0, "compact_tokens": 0})
+        stats["calls"] += 1
+        stats["raw_tokens"] += raw_tokens
+        stats["compact_tokens"] += compact_tokens
+
+    return compacted
+
+
+def output_budget(task: str, code: str):
+    """max_tokens for a task, scaled to the size of the code it will rewrite."""
+    budget = OUTPUT_BUDGETS[task]
+    return min(budget["cap"], budget["base"] + math.ceil(budget["ratio"] * count_tokens(code)))
+
+
+@app.get("/prompt/stats")
+def get_prompt_stats():
+
+    with prompt_stats_lock:
+        tasks = json.loads(json.dumps(prompt_stats))
+
+    for stats in tasks.values():
+        stats["saved_tokens"] = stats["raw_tokens"] - stats["compact_tokens"]
+        stats["saved_percent"] = round(100 * stats["saved_tokens"] / stats["raw_tokens"], 1) if stats["raw_tokens"] else 0.0
+
+    return {
+        "tokenizer": "tiktoken" if tiktoken is not None else "estimate",
+        "tasks": tasks
+    }
+
+
+# ================================
+# JSON OUTPUT
+# ================================
+
+OPTIMIZE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "optimized_code": {"type": "string"},
+        "theoretical_explanation": {"type": "string"},
+        "before_time_complexity": {"type": "string"},
+        "before_space_complexity": {"type": "string"},
+        "after_time_complexity": {"type": "string"},
+        "after_space_complexity": {"type": "string"}
+    },
+    "required": [
+        "optimized_code",
+        "theoretical_explanation",
+        "before_time_complexity",
+        "before_space_complexity",
+        "after_time_complexity",
+        "after_space_complexity"
+    ]
+}
+
+EDGE_CASE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "edge_test_cases": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "input": {},
+                    "expected_behavior": {"type": "string"}
+                },
+                "required": ["input", "expected_behavior"]
+            }
+        }
+    },
+    "required": ["edge_test_cases"]
+}
+
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+}
+
+
+def matches_schema(data, schema):
+    """Minimal check for the subset of JSON Schema used above."""
+    expected = JSON_TYPES.get(schema.get("type"))
+    if expected and not isinstance(data, expected):
+        return False
+
+    if isinstance(data, dict):
+        if any(key not in data for key in schema.get("required", [])):
+            return False
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in data and not matches_schema(data[key], sub_schema):
+                return False
+
+    if isinstance(data, list) and "items" in schema:
+        return all(matches_schema(item, schema["items"]) for item in data)
+
+    return True
+
+
+def repair_json(raw: str):
+    """
+    Parse model JSON, fixing the small mistakes models tend to make:
+    markdown fences, text around the object, trailing commas, raw
+    newlines in strings and output cut off before closing brackets.
+
+    Returns the parsed value, or None if it can't be recovered.
+    """
+    raw = raw.replace("```json", "").replace("```", "").strip()
+
+    start = raw.find("{")
+    if start == -1:
+        return None
+    raw = raw[start:]
+
+    try:
+        return json.loads(raw, strict=False)
+    except Exception:
+        pass
+
+    repaired = []
+    stack = []
+    in_string = False
+    escape = False
+    end = len(raw)
+
+    for i, char in enumerate(raw):
+        if in_string:
+            repaired.append(char)
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            # Drop trailing commas before a closing bracket
+            while repaired and repaired[-1] in " \t\r\n,":
+                repaired.pop()
+            if stack:
+                stack.pop()
+            repaired.append(char)
+            if not stack:
+                end = i + 1
+                break
+            continue
+
+        repaired.append(char)
+
+    # Close whatever the model left open
+    if stack or in_string:
+        if escape:
+            repaired.pop()
+        if in_string:
+            repaired.append('"')
+        text = "".join(repaired).rstrip()
+        previous = None
+        while text != previous:
+            previous = text
+            text = re.sub(r"[,:]\s*$", "", text)
+            # A dangling key without a value can't be kept
+            if stack[-1] == "}":
+                text = re.sub(r'([,{])\s*"[^"]*"\s*$', r"\1", text)
+            text = text.rstrip()
+        text += "".join(reversed(stack))
+    else:
+        text = "".join(repaired)[:end]
+
+    try:
+        return json.loads(text, strict=False)
+    except Exception:
+        return None
+
+
+def is_schema_output(schema):
+    return lambda raw: matches_schema(repair_json(raw), schema)
+
+
+class IncrementalJSONParser:
+    """
+    Tolerant streaming parser for a top-level JSON object.
+
+    feed() returns events as soon as they are complete:
+    - ("field", key, value) for each top-level field
+    - ("item", key, value) for each element of a top-level array
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.key = None
+        self.key_start = None
+        self.value_start = None
+        self.item_start = None
+        self.array_field = False
+
+    def parse_value(self, text):
+        text = text.strip()
+        try:
+            return json.loads(text, strict=False)
+        except Exception:
+            if text.startswith("{"):
+                return repair_json(text)
+            return text.strip('"')
+
+    def feed(self, chunk: str):
+        events = []
+        self.buffer += chunk
+
+        while self.pos < len(self.buffer) and self.depth >= 0:
+            i = self.pos
+            char = self.buffer[i]
+            self.pos += 1
+
+            if not self.started:
+                if char == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.key_start is not None:
+                        self.key = self.parse_value(self.buffer[self.key_start:i + 1])
+                        self.key_start = None
+                continue
+
+            # Between top-level fields: expecting a key or ':'
+            if self.depth == 1 and self.value_start is None:
+                if char == '"':
+                    self.key_start = i
+                    self.in_string = True
+                elif char == ":":
+                    self.value_start = -1
+                elif char == "}":
+                    self.depth = -1
+                continue
+
+            if self.depth == 1 and self.value_start == -1:
+                if char.isspace():
+                    continue
+                self.value_start = i
+                self.array_field = char == "["
+
+            depth = self.depth
+
+            # Elements of a top-level array
+            if self.array_field and depth == 2:
+                if self.item_start is None and char not in ",]" and not char.isspace():
+                    self.item_start = i
+                elif self.item_start is not None and char in ",]":
+                    item = self.parse_value(self.buffer[self.item_start:i])
+                    events.append(("item", self.key, item))
+                    self.item_start = None
+
+            # End of a top-level value
+            if depth == 1 and char in ",}":
+                value = self.parse_value(self.buffer[self.value_start:i])
+                events.append(("field", self.key, value))
+                self.key = None
+                self.value_start = None
+                self.array_field = False
+                if char == "}":
+                    self.depth = -1
+                continue
+
+            if char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+
+        return events
+
+
+def sse_event(event: str, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 
 class CodeRequest(BaseModel):
     code: str
     language: str
 
+class IncrementalReviewRequest(BaseModel):
+    code: str
+    language: str
+    previous_code: str
+
 class RewriteRequest(BaseModel):
     code: str
     language: str
@@ -90,11 +1324,14 @@ class CommentRequest(BaseModel):
 class RunRequest(BaseModel):
     code: str
     language: str
+    stdin: str = ""
+    profile: bool = False
 
 class WorkspaceCreate(BaseModel):
     user_id: str
     name: str
     repo_url: str
+    idempotency_key: Optional[str] = None
 
 class WorkspaceReviewRequest(BaseModel):
     user_id: str
@@ -102,6 +1339,12 @@ class WorkspaceReviewRequest(BaseModel):
     code: str
     language: str
 
+class WorkspaceFileUpdate(BaseModel):
+    user_id: str
+    workspace_id: str
+    path: str
+    content: str
+
 class DocumentationRequest(BaseModel):
     user_id: str
     workspace_id: str
@@ -115,12 +1358,30 @@ class EdgeCaseRequest(BaseModel):
     code: str
     language: str
 
+class OptimizeVerifyRequest(BaseModel):
+    code: str
+    optimized_code: str
+    language: str
+    before_time_complexity: str = ""
+    after_time_complexity: str = ""
+    input_generator: Optional[str] = None
+    sizes: Optional[list] = None
+    timeout: float = 5
+
+class EdgeCaseRunRequest(BaseModel):
+    code: str
+    language: str
+    edge_test_cases: list
+    timeout: float = 2
+    function: Optional[str] = None
+
 class GenerateRequest(BaseModel):
     message: str
     language: str
     history: list = []
+    session_id: Optional[str] = None
 
-@app.post("/workspace/explain")
+@app.post("/workspace/explain", dependencies=[Depends(admit_llm)])
 def explain_workspace(request: ExplainProjectRequest):
 
     workspace_ref = db.collection("users") \
@@ -135,23 +1396,29 @@ def explain_workspace(request: ExplainProjectRequest):
 
     workspace_data = workspace_doc.to_dict()
 
-    files_ref = workspace_ref.collection("files").stream()
-    files = [file.to_dict() for file in files_ref]
-
-    prompt = build_project_explanation_prompt(
-        files,
-        workspace_data.get("tech_stack", [])
-    )
-
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3,
-        max_tokens=1200
+    def explain():
+        files = [file.to_dict() for file in workspace_ref.collection("files").stream()]
+
+        prompt = build_project_explanation_prompt(
+            files,
+            workspace_data.get("tech_stack", [])
+        )
+
+        return call_llm(
+            "explain",
+            prompt,
+            input_text=prompt,
+            temperature=0.3,
+            max_tokens=1200
+        ).strip()
+
+    explanation = cached_artifact(
+        workspace_ref,
+        "explain",
+        workspace_data.get("commit_sha"),
+        explain
     )
 
-    explanation = response.choices[0].message.content.strip()
-
     return {
         "explanation": explanation
     }
@@ -179,16 +1446,17 @@ Be structured and detailed.
 """
 
 
-def fetch_repo_files(repo_url):
+def fetch_repo_files(repo_url, ref=None):
     parts = repo_url.rstrip("/").split("/")
     owner = parts[-2]
     repo = parts[-1]
 
     all_files = []
+    params = {"ref": ref} if ref else None
 
     def fetch_directory(path=""):
         api_url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
-        response = requests.get(api_url)
+        response = requests.get(api_url, params=params)
 
         if response.status_code != 200:
             print("GitHub API Error:", response.status_code, response.text)
@@ -205,6 +1473,8 @@ def fetch_repo_files(repo_url):
                     "name": item["name"],
                     "path": item["path"],
                     "download_url": item["download_url"],
+                    "sha": item.get("sha"),
+                    "size": item.get("size", 0),
                     "type": "file"
                 })
             elif item["type"] == "dir":
@@ -222,12 +1492,7 @@ def generate_project_summary(tech_stack, files):
     Explain in 4-5 lines what this project likely does.
     """
 
-    response = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=[{"role": "user", "content": prompt}]
-    )
-
-    return response.choices[0].message.content
+    return call_llm("summary", prompt, input_text=prompt)
 
 @app.get("/workspace/{user_id}/{workspace_id}/files")
 def get_workspace_files(user_id: str, workspace_id: str):
@@ -248,448 +1513,3410 @@ def get_workspace_files(user_id: str, workspace_id: str):
 
     return result
 
-@app.get("/workspace/file-content")
-def get_file_content(download_url: str):
+# ================================
+# DERIVED ARTIFACTS
+# ================================
 
-    try:
-        response = requests.get(download_url)
+# Bump a kind's version when its prompt changes so stored output is regenerated
+PROMPT_VERSIONS = {
+    "summary": "1",
+    "explain": "1",
+    "docs": "1",
+}
+HEAD_SHA_TTL = 60
 
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to fetch file")
+head_sha_lock = Lock()
+head_sha_cache = {}
 
-        return {
-            "content": response.text
-        }
+artifact_stats_lock = Lock()
+artifact_stats = {kind: {"hits": 0, "misses": 0, "uncached": 0} for kind in PROMPT_VERSIONS}
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
-def build_generate_prompt(user_prompt: str, language: str):
-    return f"""
-You are a senior software engineer.
+def repo_slug(repo_url: str):
+    parts = repo_url.rstrip("/").removesuffix(".git").split("/")
+    return f"{parts[-2]}/{parts[-1]}".lower()
 
-Generate clean, production-ready {language} code.
 
-STRICT RULES:
-- Output ONLY raw code
-- NO markdown
-- NO explanations
-- NO commentary
-- Ensure complete and correct syntax
-- Follow best practices
-- Start directly with code.
+def fetch_head_sha(repo_url: str):
+    """Commit SHA of the repo's default branch, or None if GitHub can't tell us."""
+    slug = repo_slug(repo_url)
+    now = time.monotonic()
 
-Task:
-{user_prompt}
-"""
-@app.post("/generate")
-def generate_code(request: GenerateRequest):
+    with head_sha_lock:
+        cached = head_sha_cache.get(slug)
+        if cached and now - cached[1] < HEAD_SHA_TTL:
+            return cached[0]
 
-    if not request.message.strip():
-        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    try:
+        response = requests.get(
+            f"https://api.github.com/repos/{slug}/commits/HEAD",
+            headers={"Accept": "application/vnd.github.sha"},
+            timeout=10
+        )
+    except requests.RequestException as e:
+        print("HEAD SHA LOOKUP FAILED:", slug, e)
+        return None
 
-    if request.language.lower() not in SUPPORTED_LANGUAGES:
-        raise HTTPException(status_code=400, detail="Unsupported language")
+    if response.status_code != 200:
+        print("HEAD SHA LOOKUP FAILED:", slug, response.status_code)
+        return None
 
-    prompt = f"""
-You are a senior {request.language} software engineer.
+    sha = response.text.strip()
 
-If this is the first message, generate COMPLETE production-ready code.
+    with head_sha_lock:
+        head_sha_cache[slug] = (sha, now)
 
-If the user provides an instruction, modify the EXISTING code accordingly.
+    return sha
 
-Return ONLY raw full code.
-No markdown.
-No explanations.
 
-Current Code:
-{request.history[-1]['content'] if request.history else ""}
+def artifact_ref(parent_ref, kind: str, variant: str = ""):
+    # Variants like doc_type are user input, so hash them into a valid doc id
+    doc_id = kind
+    if variant:
+        doc_id += "-" + hashlib.sha1(variant.encode()).hexdigest()[:16]
+    return parent_ref.collection("artifacts").document(doc_id)
+
+
+def cached_artifact(parent_ref, kind: str, commit_sha: Optional[str], generate, variant: str = ""):
+    """
+    Return the stored `kind` artifact for commit_sha, generating and storing
+    it when the commit or prompt version changed. Without a tracked SHA
+    there's nothing to key on, so the artifact is generated every time.
+    """
+    if commit_sha is None:
+        with artifact_stats_lock:
+            artifact_stats[kind]["uncached"] += 1
+        return generate()
+
+    ref = artifact_ref(parent_ref, kind, variant)
+    doc = ref.get()
+    data = doc.to_dict() if doc.exists else None
+
+    if data and data.get("commit_sha") == commit_sha and data.get("prompt_version") == PROMPT_VERSIONS[kind]:
+        with artifact_stats_lock:
+            artifact_stats[kind]["hits"] += 1
+        return data["content"]
+
+    content = generate()
+
+    ref.set({
+        "kind": kind,
+        "variant": variant,
+        "commit_sha": commit_sha,
+        "prompt_version": PROMPT_VERSIONS[kind],
+        "content": content,
+        "created_at": datetime.utcnow()
+    })
+
+    with artifact_stats_lock:
+        artifact_stats[kind]["misses"] += 1
+
+    return content
+
+
+def repo_ref(repo_url: str):
+    return db.collection("repos").document(hashlib.sha1(repo_slug(repo_url).encode()).hexdigest())
+
+
+def delete_artifacts(parent_ref):
+    for doc in parent_ref.collection("artifacts").stream():
+        doc.reference.delete()
+
+
+@app.get("/artifacts/stats")
+def get_artifact_stats():
+
+    with artifact_stats_lock:
+        return json.loads(json.dumps(artifact_stats))
+
+
+# ================================
+# BLOB STORE
+# ================================
+
+# Firestore documents are capped at 1 MiB; larger files stay on GitHub
+MAX_BLOB_BYTES = 900_000
+BLOB_CACHE_SIZE = 200
+
+blob_cache_lock = Lock()
+blob_cache = OrderedDict()
+
+
+def blob_ref(sha: str):
+    return db.collection("blobs").document(sha)
+
+
+def download_text(download_url: str):
+    response = requests.get(download_url)
+
+    if response.status_code != 200:
+        return None
+
+    try:
+        return response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+@firestore.transactional
+def add_blob_ref(transaction, ref, content: str):
+    snapshot = ref.get(transaction=transaction)
+
+    if snapshot.exists:
+        transaction.update(ref, {"ref_count": firestore.Increment(1)})
+        return True
+
+    if content is None:
+        return False
+
+    transaction.set(ref, {
+        "content": content,
+        "size": len(content.encode("utf-8")),
+        "ref_count": 1,
+        "created_at": datetime.utcnow()
+    })
+    return True
+
+
+@firestore.transactional
+def release_blob_ref(transaction, ref):
+    snapshot = ref.get(transaction=transaction)
+
+    if not snapshot.exists:
+        return
+
+    if snapshot.to_dict().get("ref_count", 1) <= 1:
+        transaction.delete(ref)
+    else:
+        transaction.update(ref, {"ref_count": firestore.Increment(-1)})
+
+
+@firestore.transactional
+def link_file_blob(transaction, file_ref, file_doc: dict, sha: Optional[str], content: Optional[str]):
+    """
+    Write a file doc pointing at blob `sha` (or None) and move the blob
+    references with it in the same transaction: +1 on the new blob, -1
+    on the one the doc pointed at before. A reference exists exactly when
+    a committed doc holds it, so an interrupted or retried ingestion can't
+    leak or double-count one.
+
+    Returns False if the blob doesn't exist and no content was given.
+    """
+    snapshot = file_ref.get(transaction=transaction)
+    old_sha = snapshot.to_dict().get("blob_sha") if snapshot.exists else None
+
+    if old_sha != sha:
+        # All reads before any write
+        new_blob = blob_ref(sha).get(transaction=transaction) if sha else None
+        old_blob = blob_ref(old_sha).get(transaction=transaction) if old_sha else None
+
+        if new_blob is not None:
+            if new_blob.exists:
+                transaction.update(new_blob.reference, {"ref_count": firestore.Increment(1)})
+            elif content is None:
+                return False
+            else:
+                transaction.set(new_blob.reference, {
+                    "content": content,
+                    "size": len(content.encode("utf-8")),
+                    "ref_count": 1,
+                    "created_at": datetime.utcnow()
+                })
+
+        if old_blob is not None and old_blob.exists:
+            if old_blob.to_dict().get("ref_count", 1) <= 1:
+                transaction.delete(old_blob.reference)
+            else:
+                transaction.update(old_blob.reference, {"ref_count": firestore.Increment(-1)})
+
+    transaction.set(file_ref, {**file_doc, "blob_sha": sha})
+    return True
+
+
+def store_file(file, file_ref, file_doc: dict):
+    """
+    Save a file doc with a reference to the file's content in the shared
+    blob store, downloading it only if no workspace has stored it yet.
+
+    Returns the blob SHA, or None if the content isn't stored (binary,
+    too large or unavailable).
+    """
+    sha = file.get("sha")
+
+    if not sha or not file.get("download_url") or file.get("size", 0) > MAX_BLOB_BYTES:
+        sha = None
+
+    content = None
+    if sha and not blob_ref(sha).get().exists:
+        content = download_text(file["download_url"])
+        if content is None:
+            sha = None
+
+    if not link_file_blob(db.transaction(), file_ref, file_doc, sha, content):
+        # Garbage collected between the existence check and the transaction
+        content = download_text(file["download_url"])
+        if content is None or not link_file_blob(db.transaction(), file_ref, file_doc, sha, content):
+            sha = None
+            link_file_blob(db.transaction(), file_ref, file_doc, None, None)
+
+    return sha
+
+
+def release_blob(sha: str):
+    release_blob_ref(db.transaction(), blob_ref(sha))
+
+    with blob_cache_lock:
+        blob_cache.pop(sha, None)
+
+
+def read_blob(sha: str):
+    with blob_cache_lock:
+        if sha in blob_cache:
+            blob_cache.move_to_end(sha)
+            return blob_cache[sha]
+
+    snapshot = blob_ref(sha).get()
+    if not snapshot.exists:
+        return None
+
+    content = snapshot.to_dict().get("content")
+
+    # Blobs are immutable, so cached copies never go stale
+    with blob_cache_lock:
+        blob_cache[sha] = content
+        while len(blob_cache) > BLOB_CACHE_SIZE:
+            blob_cache.popitem(last=False)
+
+    return content
+
+
+@app.get("/workspace/file-content")
+def get_file_content(download_url: str, blob_sha: Optional[str] = None):
+
+    if blob_sha:
+        content = read_blob(blob_sha)
+        if content is not None:
+            return {
+                "content": content
+            }
+
+    try:
+        response = requests.get(download_url)
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail="Failed to fetch file")
+
+        return {
+            "content": response.text
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.delete("/workspace/{user_id}/{workspace_id}")
+def delete_workspace(user_id: str, workspace_id: str):
+
+    workspace_ref = db.collection("users") \
+                      .document(user_id) \
+                      .collection("workspaces") \
+                      .document(workspace_id)
+
+    if not workspace_ref.get().exists:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+
+    released = 0
+
+    for file in workspace_ref.collection("files").stream():
+        blob_sha = file.to_dict().get("blob_sha")
+        if blob_sha:
+            release_blob(blob_sha)
+            released += 1
+        file.reference.delete()
+
+    delete_artifacts(workspace_ref)
+    workspace_ref.delete()
+
+    # Wait out a build in progress so it can't re-add the index
+    with index_build_lock(user_id, workspace_id), index_lock:
+        workspace_indexes.pop((user_id, workspace_id), None)
+
+    return {
+        "deleted": workspace_id,
+        "released_blobs": released
+    }
+
+def build_generate_prompt(user_prompt: str, language: str):
+    return f"""
+You are a senior software engineer.
+
+Generate clean, production-ready {language} code.
+
+STRICT RULES:
+- Output ONLY raw code
+- NO markdown
+- NO explanations
+- NO commentary
+- Ensure complete and correct syntax
+- Follow best practices
+- Start directly with code.
+
+Task:
+{user_prompt}
+"""
+# ================================
+# WORKSPACE SEARCH INDEX
+# ================================
+
+INDEX_BUILD_WORKERS = 8
+MAX_SEARCH_RESULTS = 200
+
+# Definitions by file extension: (kind, pattern with the name in group 1)
+SYMBOL_PATTERNS = {
+    ("js", "jsx", "ts", "tsx", "mjs"): [
+        ("function", r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+)"),
+        ("class", r"^\s*(?:export\s+)?(?:default\s+)?class\s+(\w+)"),
+        ("function", r"^\s*(?:export\s+)?(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s*)?(?:function\b|\([^)]*\)\s*=>|\w+\s*=>)"),
+    ],
+    ("java", "cs", "kt"): [
+        ("class", r"^\s*(?:[\w@]+\s+)*(?:class|interface|enum|record|object)\s+(\w+)"),
+        ("function", r"^\s*(?:(?:public|private|protected|internal|static|final|abstract|override|suspend|async|virtual)\s+)*(?:fun\s+)?[\w<>\[\],.?]+\s+(\w+)\s*\([^;]*$"),
+    ],
+    ("c", "h", "cpp", "cc", "hpp"): [
+        ("class", r"^\s*(?:typedef\s+)?(?:struct|class|union|enum)\s+(\w+)"),
+        ("function", r"^[\w\*&:<>\s]+?\b(\w+)\s*\([^;]*\)\s*(?:const\s*)?\{?\s*$"),
+    ],
+    ("go",): [
+        ("function", r"^func\s+(?:\([^)]*\)\s*)?(\w+)"),
+        ("class", r"^type\s+(\w+)"),
+    ],
+    ("rs",): [
+        ("function", r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?fn\s+(\w+)"),
+        ("class", r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait)\s+(\w+)"),
+    ],
+    ("php",): [
+        ("function", r"^\s*(?:(?:public|private|protected|static|abstract|final)\s+)*function\s+(\w+)"),
+        ("class", r"^\s*(?:abstract\s+|final\s+)?(?:class|interface|trait)\s+(\w+)"),
+    ],
+    ("rb",): [
+        ("function", r"^\s*def\s+(?:self\.)?(\w+[?!]?)"),
+        ("class", r"^\s*(?:class|module)\s+(\w+)"),
+    ],
+    ("swift",): [
+        ("function", r"^\s*(?:(?:public|private|internal|static|override)\s+)*func\s+(\w+)"),
+        ("class", r"^\s*(?:(?:public|private|internal|final)\s+)*(?:class|struct|enum|protocol)\s+(\w+)"),
+    ],
+}
+
+C_KEYWORDS = {"if", "for", "while", "switch", "return", "else", "sizeof", "catch"}
+
+
+def trigrams(text: str):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def extract_symbols(path: str, content: str):
+    extension = path.rsplit(".", 1)[-1].lower() if "." in path else ""
+
+    if extension == "py":
+        try:
+            tree = ast.parse(content)
+        except SyntaxError:
+            tree = None
+        if tree is not None:
+            return [
+                {
+                    "name": node.name,
+                    "kind": "class" if isinstance(node, ast.ClassDef) else "function",
+                    "path": path,
+                    "line": node.lineno
+                }
+                for node in ast.walk(tree)
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+            ]
+        patterns = [("function", r"^\s*(?:async\s+)?def\s+(\w+)"), ("class", r"^\s*class\s+(\w+)")]
+    else:
+        patterns = next(
+            (patterns for extensions, patterns in SYMBOL_PATTERNS.items() if extension in extensions),
+            []
+        )
+
+    symbols = []
+    for number, line in enumerate(content.splitlines(), 1):
+        for kind, pattern in patterns:
+            match = re.match(pattern, line)
+            if match and match.group(1) not in C_KEYWORDS:
+                symbols.append({"name": match.group(1), "kind": kind, "path": path, "line": number})
+                break
+
+    return symbols
+
+
+class WorkspaceIndex:
+    """
+    Trigram index over file contents plus a symbol table. Queries use the
+    trigram postings to pick candidate files and only scan those.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.files = {}
+        self.file_trigrams = {}
+        self.postings = {}
+        self.symbols = {}
+        self.file_symbols = {}
+
+    def add_file(self, path: str, content: str):
+        with self.lock:
+            self.remove_locked(path)
+
+            self.files[path] = content.splitlines()
+            self.file_trigrams[path] = trigrams(content)
+            for trigram in self.file_trigrams[path]:
+                self.postings.setdefault(trigram, set()).add(path)
+
+            self.file_symbols[path] = extract_symbols(path, content)
+            for symbol in self.file_symbols[path]:
+                self.symbols.setdefault(symbol["name"], []).append(symbol)
+
+    def remove_file(self, path: str):
+        with self.lock:
+            self.remove_locked(path)
+
+    def remove_locked(self, path: str):
+        for trigram in self.file_trigrams.pop(path, ()):
+            paths = self.postings.get(trigram)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.postings[trigram]
+
+        for symbol in self.file_symbols.pop(path, ()):
+            remaining = [item for item in self.symbols.get(symbol["name"], []) if item["path"] != path]
+            if remaining:
+                self.symbols[symbol["name"]] = remaining
+            else:
+                self.symbols.pop(symbol["name"], None)
+
+        self.files.pop(path, None)
+
+    def candidates(self, text: str):
+        grams = trigrams(text)
+        if not grams:
+            return sorted(self.files)
+
+        paths = None
+        for trigram in sorted(grams, key=lambda gram: len(self.postings.get(gram, ()))):
+            paths = set(self.postings.get(trigram, ())) if paths is None else paths & self.postings.get(trigram, set())
+            if not paths:
+                return []
+        return sorted(paths)
+
+    def scan(self, text: str, matcher, limit: int):
+        results = []
+        with self.lock:
+            for path in self.candidates(text):
+                for number, line in enumerate(self.files[path], 1):
+                    if matcher(line):
+                        results.append({"path": path, "line": number, "text": line.strip()})
+                        if len(results) >= limit:
+                            return results
+        return results
+
+    def search(self, query: str, limit: int):
+        needle = query.lower()
+        return self.scan(query, lambda line: needle in line.lower(), limit)
+
+    def definitions(self, name: str):
+        with self.lock:
+            return list(self.symbols.get(name, []))
+
+    def usages(self, name: str, limit: int):
+        pattern = re.compile(rf"(?<![\w$]){re.escape(name)}(?![\w$])")
+        definitions = {(symbol["path"], symbol["line"]) for symbol in self.definitions(name)}
+        return [
+            {**result, "is_definition": (result["path"], result["line"]) in definitions}
+            for result in self.scan(name, pattern.search, limit)
+        ]
+
+
+MAX_WORKSPACE_INDEXES = int(os.getenv("MAX_WORKSPACE_INDEXES", "32"))
+INDEX_BUILD_LOCKS = 64
+
+index_lock = Lock()
+workspace_indexes = OrderedDict()
+
+# Builds of the same workspace run one at a time; striped so the locks
+# don't grow with the number of workspaces
+index_build_locks = [Lock() for _ in range(INDEX_BUILD_LOCKS)]
+
+
+def index_build_lock(user_id: str, workspace_id: str):
+    return index_build_locks[hash((user_id, workspace_id)) % INDEX_BUILD_LOCKS]
+
+
+def workspace_doc_ref(user_id: str, workspace_id: str):
+    return db.collection("users") \
+             .document(user_id) \
+             .collection("workspaces") \
+             .document(workspace_id)
+
+
+def workspace_files_ref(user_id: str, workspace_id: str):
+    return workspace_doc_ref(user_id, workspace_id).collection("files")
+
+
+def build_workspace_index(user_id: str, workspace_id: str):
+    with index_build_lock(user_id, workspace_id):
+        return build_workspace_index_locked(user_id, workspace_id)
+
+
+def build_workspace_index_locked(user_id: str, workspace_id: str):
+    if not workspace_doc_ref(user_id, workspace_id).get().exists:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+
+    index = WorkspaceIndex()
+    files = [
+        file.to_dict() for file in workspace_files_ref(user_id, workspace_id).stream()
+    ]
+    stored = [file for file in files if file.get("blob_sha")]
+
+    def add(file):
+        content = read_blob(file["blob_sha"])
+        if content is not None:
+            index.add_file(file["path"], content)
+
+    with ThreadPoolExecutor(max_workers=INDEX_BUILD_WORKERS) as pool:
+        list(pool.map(add, stored))
+
+    with index_lock:
+        workspace_indexes[(user_id, workspace_id)] = index
+        workspace_indexes.move_to_end((user_id, workspace_id))
+        while len(workspace_indexes) > MAX_WORKSPACE_INDEXES:
+            workspace_indexes.popitem(last=False)
+
+    print(f"INDEXED {workspace_id}: {len(index.files)} files, {len(index.symbols)} symbols")
+    return index
+
+
+def cached_workspace_index(user_id: str, workspace_id: str):
+    with index_lock:
+        index = workspace_indexes.get((user_id, workspace_id))
+        if index is not None:
+            workspace_indexes.move_to_end((user_id, workspace_id))
+        return index
+
+
+def get_workspace_index(user_id: str, workspace_id: str):
+    index = cached_workspace_index(user_id, workspace_id)
+    if index is not None:
+        return index
+
+    # Indexes live in memory; rebuild from the blob store after a restart
+    # or eviction. Concurrent requests wait for one build and reuse it.
+    with index_build_lock(user_id, workspace_id):
+        index = cached_workspace_index(user_id, workspace_id)
+        return index if index is not None else build_workspace_index_locked(user_id, workspace_id)
+
+
+def git_blob_sha(content: str):
+    data = content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+@app.get("/workspace/{user_id}/{workspace_id}/search")
+def search_workspace(user_id: str, workspace_id: str, q: str, limit: int = 50):
+
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+
+    started = time.perf_counter()
+    results = get_workspace_index(user_id, workspace_id).search(q, min(limit, MAX_SEARCH_RESULTS))
+
+    return {
+        "results": results,
+        "time_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+
+@app.get("/workspace/{user_id}/{workspace_id}/definition")
+def find_definition(user_id: str, workspace_id: str, symbol: str):
+
+    return {
+        "definitions": get_workspace_index(user_id, workspace_id).definitions(symbol)
+    }
+
+
+@app.get("/workspace/{user_id}/{workspace_id}/usages")
+def find_usages(user_id: str, workspace_id: str, symbol: str, limit: int = 100):
+
+    if not re.fullmatch(r"[\w$]+[?!]?", symbol):
+        raise HTTPException(status_code=400, detail="Invalid symbol name")
+
+    return {
+        "usages": get_workspace_index(user_id, workspace_id).usages(symbol, min(limit, MAX_SEARCH_RESULTS))
+    }
+
+
+@app.put("/workspace/file")
+def update_workspace_file(data: WorkspaceFileUpdate):
+    """
+    Save new content for a workspace file: store it as a new blob, move
+    the file's reference to it and update the search index for that file.
+    """
+
+    if len(data.content.encode("utf-8")) > MAX_BLOB_BYTES:
+        raise HTTPException(status_code=400, detail="File too large")
+
+    matches = list(
+        workspace_files_ref(data.user_id, data.workspace_id)
+        .where("path", "==", data.path)
+        .limit(1)
+        .stream()
+    )
+
+    if not matches:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    snapshot = matches[0]
+    file_ref = snapshot.reference
+    old_sha = snapshot.to_dict().get("blob_sha")
+    new_sha = git_blob_sha(data.content)
+
+    if new_sha != old_sha:
+        add_blob_ref(db.transaction(), blob_ref(new_sha), data.content)
+        file_ref.update({"blob_sha": new_sha, "size": len(data.content.encode("utf-8"))})
+        if old_sha:
+            release_blob(old_sha)
+
+    get_workspace_index(data.user_id, data.workspace_id).add_file(data.path, data.content)
+
+    return {
+        "path": data.path,
+        "blob_sha": new_sha
+    }
+
+
+# ================================
+# GENERATE SESSIONS
+# ================================
+
+SESSION_TTL = 60 * 60
+MAX_SESSIONS = 1000
+
+session_lock = Lock()
+generate_sessions = {}
+
+
+def get_session(session_id: str):
+    with session_lock:
+        session = generate_sessions.get(session_id)
+        if session and time.time() - session["updated_at"] > SESSION_TTL:
+            del generate_sessions[session_id]
+            session = None
+        return dict(session) if session else None
+
+
+def save_session(session_id: str, code: str, language: str):
+    with session_lock:
+        generate_sessions[session_id] = {
+            "code": code,
+            "language": language,
+            "updated_at": time.time()
+        }
+
+        # Evict the least recently used sessions
+        if len(generate_sessions) > MAX_SESSIONS:
+            oldest = sorted(generate_sessions, key=lambda key: generate_sessions[key]["updated_at"])
+            for key in oldest[:len(generate_sessions) - MAX_SESSIONS]:
+                del generate_sessions[key]
+
+
+def apply_unified_diff(original: str, diff_text: str):
+    """
+    Apply a unified diff to `original`.
+
+    Hunks are located by their context and removed lines rather than the
+    @@ line numbers, which models often get wrong. Raises ValueError if a
+    hunk can't be placed.
+    """
+    hunks = []
+    hunk = None
+
+    for line in diff_text.replace("```diff", "").replace("```", "").splitlines():
+        if line.startswith("@@"):
+            match = re.match(r"@@ -(\d+)(?:,(\d+))?", line)
+            start = int(match.group(1)) - 1 if match else 0
+            # "-7,0" is an insertion after line 7, not before it
+            if match and match.group(2) == "0":
+                start += 1
+            hunk = {"start": start, "old": [], "new": []}
+            hunks.append(hunk)
+        elif hunk is None or line.startswith("--- ") or line.startswith("+++ "):
+            continue
+        elif line.startswith("+"):
+            hunk["new"].append(line[1:])
+        elif line.startswith("-"):
+            hunk["old"].append(line[1:])
+        elif line.startswith(" ") or line == "":
+            hunk["old"].append(line[1:])
+            hunk["new"].append(line[1:])
+        elif line.startswith("\\"):
+            continue
+        else:
+            raise ValueError(f"Unexpected diff line: {line!r}")
+
+    if not hunks:
+        raise ValueError("No hunks in diff")
+
+    lines = original.splitlines()
+    cursor = 0
+
+    for hunk in sorted(hunks, key=lambda hunk: hunk["start"]):
+        old = [line.rstrip() for line in hunk["old"]]
+
+        # Drop trailing blank context the model may have added
+        while old and hunk["new"] and old[-1] == "" and hunk["new"][-1].rstrip() == "":
+            old.pop()
+            hunk["new"].pop()
+
+        if not old:
+            position = min(max(hunk["start"], cursor), len(lines))
+        else:
+            candidates = [
+                i for i in range(cursor, len(lines) - len(old) + 1)
+                if [line.rstrip() for line in lines[i:i + len(old)]] == old
+            ]
+            if not candidates:
+                raise ValueError("Hunk context not found")
+            position = min(candidates, key=lambda i: abs(i - hunk["start"]))
+
+        lines[position:position + len(old)] = hunk["new"]
+        cursor = position + len(hunk["new"])
+
+    return "\n".join(lines) + ("\n" if original.endswith("\n") else "")
+
+
+def build_generate_diff_prompt(code: str, instruction: str, language: str):
+    return f"""
+You are a senior {language} software engineer.
+
+Modify the code below according to the instruction.
+
+Return ONLY a unified diff against the code:
+--- a/code
++++ b/code
+@@ -<line>,<count> +<line>,<count> @@
+ context line
+-removed line
++added line
+
+Rules:
+- Include 2 lines of unchanged context around each change.
+- Copy context and removed lines exactly.
+- No markdown.
+- No explanations.
+
+Code:
+{code}
+
+User Instruction:
+{instruction}
+"""
+
+
+@app.post("/generate", dependencies=[Depends(admit_llm)])
+def generate_code(request: GenerateRequest):
+
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    session_id = request.session_id or str(uuid.uuid4())
+    session = get_session(session_id) if request.session_id else None
+
+    if request.session_id and not session and not request.history:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+
+    # Existing code: send only the requested change and apply the returned diff
+    if session and session["code"]:
+        diff_text = call_llm(
+            "generate",
+            build_generate_diff_prompt(session["code"], request.message, request.language),
+            input_text=session["code"],
+            continuation_budget=CONTINUATION_TOKEN_BUDGET,
+            temperature=0.2,
+            max_tokens=800
+        )
+
+        try:
+            code = apply_unified_diff(session["code"], diff_text)
+
+            # A diff cut off mid-hunk can still apply; don't accept a patch
+            # that breaks code which used to parse
+            patched_valid = check_syntax(code, request.language)["valid"]
+            if patched_valid is False and check_syntax(session["code"], request.language)["valid"] is not False:
+                raise ValueError("Patched code has syntax errors")
+
+            save_session(session_id, code, request.language)
+            return {
+                "code": code,
+                "session_id": session_id,
+                "mode": "diff"
+            }
+        except ValueError as e:
+            print("GENERATE DIFF FAILED, regenerating:", e)
+
+    current_code = session["code"] if session else (
+        request.history[-1]['content'] if request.history else ""
+    )
+
+    prompt = f"""
+You are a senior {request.language} software engineer.
+
+If this is the first message, generate COMPLETE production-ready code.
+
+If the user provides an instruction, modify the EXISTING code accordingly.
+
+Return ONLY raw full code.
+No markdown.
+No explanations.
+
+Current Code:
+{current_code}
 
 User Instruction:
 {request.message}
 """
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.4,
-        max_tokens=1500
-    )
+    result = call_llm(
+        "generate",
+        prompt,
+        input_text=prompt,
+        continuation_budget=CONTINUATION_TOKEN_BUDGET,
+        temperature=0.4,
+        max_tokens=1500
+    ).strip()
+    result = result.replace("```", "").strip()
+
+    save_session(session_id, result, request.language)
+
+    return {
+        "code": result,
+        "session_id": session_id,
+        "mode": "full"
+    }
+
+def build_comment_prompt(code: str, language: str):
+    return f"""
+You are a senior software engineer.
+
+Add clear and helpful comments to this {language} code.
+
+COMMENTING RULES:
+- Add a short comment above each function explaining its purpose.
+- Add short inline comments for important logic.
+- Do NOT add long documentation blocks.
+- Do NOT use JavaDoc or multi-line documentation.
+- Keep comments concise (1 line each).
+- Do NOT over-comment obvious lines.
+- Do NOT modify logic.
+- Preserve structure exactly.
+- Use correct comment syntax for {language}.
+- Output ONLY the full commented code.
+- No markdown.
+- No explanations outside code.
+
+Code:
+{code}
+"""
+
+@app.post("/comment", dependencies=[Depends(admit_llm)])
+def add_comments(request: CommentRequest):
+
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    code = compact_code("comment", request.code, request.language)
+
+    prompt = build_comment_prompt(
+        code,
+        request.language
+    )
+
+    result = call_llm(
+        "comment",
+        prompt,
+        input_text=code,
+        continuation_budget=CONTINUATION_TOKEN_BUDGET,
+        temperature=0.2,
+        max_tokens=output_budget("comment", code)
+    ).strip()
+    result = result.replace("```", "").strip()
+
+    return {
+        "commented_code": result
+    }
+
+
+def build_review_prompt(language: str, code: str, scope: str = ""):
+    return f"""
+You are a senior {language} software engineer and security expert.
+
+IMPORTANT:
+- Analyze the code strictly as {language}.
+- Do NOT assume Python unless explicitly provided.
+- Follow {language} best practices.
+- Detect language-specific vulnerabilities.
+- Code lines are numbered; start each issue with "Line <n>:" when it refers to specific code.
+{scope}
+Analyze the following code and return the review in EXACTLY this format:
+
+## 🔴 Critical Issues
+- List critical bugs, security vulnerabilities, or crashes.
+
+## 🟠 High Priority
+- List major performance or logic issues.
+
+## 🟡 Medium Priority
+- List maintainability or readability issues.
+
+## 🟢 Low Priority
+- List minor improvements or style suggestions.
+
+Language: {language}
+
+Code:
+{code}
+"""
+
+
+def number_lines(lines, start: int = 1):
+    return "\n".join(f"{number:>4} | {line}" for number, line in enumerate(lines, start))
+
+
+# ================================
+# REVIEW FINDINGS CACHE
+# ================================
+
+REVIEW_CACHE_SIZE = 500
+REVIEW_CONTEXT_LINES = 3
+
+review_cache_lock = Lock()
+review_cache = OrderedDict()
+
+SEVERITIES = {
+    "critical": "🔴 Critical Issues",
+    "high": "🟠 High Priority",
+    "medium": "🟡 Medium Priority",
+    "low": "🟢 Low Priority",
+}
+
+
+def review_cache_key(code: str, language: str):
+    return hashlib.sha256(f"{language.lower()}\0{code}".encode()).hexdigest()
+
+
+def cache_findings(code: str, language: str, findings):
+    with review_cache_lock:
+        review_cache[review_cache_key(code, language)] = findings
+        review_cache.move_to_end(review_cache_key(code, language))
+        while len(review_cache) > REVIEW_CACHE_SIZE:
+            review_cache.popitem(last=False)
+
+
+def cached_findings(code: str, language: str):
+    with review_cache_lock:
+        return review_cache.get(review_cache_key(code, language))
+
+
+def parse_review_findings(review_text: str):
+    findings = []
+
+    for severity, section in parse_review_response(review_text).items():
+        for line in section.splitlines()[1:]:
+            text = line.strip()
+
+            if text.startswith(("-", "*")):
+                text = text.lstrip("-* ").strip()
+                if text and text.lower() != "none":
+                    match = re.search(r"\b[Ll]ines? (\d+)", text)
+                    findings.append({
+                        "severity": severity,
+                        "line": int(match.group(1)) if match else None,
+                        "text": text
+                    })
+            elif text and findings and findings[-1]["severity"] == severity:
+                # Continuation of the previous bullet
+                findings[-1]["text"] += " " + text
+
+    return findings
+
+
+def render_review(findings):
+    structured = {}
+    sections = []
+
+    for severity, heading in SEVERITIES.items():
+        items = [f"- {finding['text']}" for finding in findings if finding["severity"] == severity]
+        body = "\n".join(items) if items else "- None"
+        structured[severity] = f"## {heading.split(' ', 1)[1]}\n{body}"
+        sections.append(f"## {heading}\n{body}")
+
+    return "\n\n".join(sections), structured
+
+
+def move_finding(finding, new_line: int):
+    offset = new_line - finding["line"]
+
+    # Shift every number of the reference, e.g. "Lines 20-22" or "Lines 4, 9"
+    def shift(match):
+        numbers = re.sub(r"\d+", lambda number: str(int(number.group()) + offset), match.group(2))
+        return f"{match.group(1)}{numbers}"
+
+    text = re.sub(
+        rf"\b([Ll]ines?\s+)({finding['line']}\b(?:\s*(?:-|–|,|and|to)\s*\d+)*)",
+        shift,
+        finding["text"],
+        count=1
+    )
+    return {**finding, "line": new_line, "text": text}
+
+
+@app.post("/review", dependencies=[Depends(admit_llm)])
+def review_code(request: CodeRequest):
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    code = compact_code("review", request.code, request.language)
+    prompt = build_review_prompt(request.language, number_lines(code.splitlines()))
+
+    review_text = call_llm(
+        "review",
+        prompt,
+        input_text=request.code,
+        validate=has_all_review_sections,
+        temperature=0.3,
+        max_tokens=output_budget("review", code)
+    )
+    structured_review = parse_review_response(review_text)
+
+    cache_findings(request.code, request.language, parse_review_findings(review_text))
+
+    return {
+        "raw_review": review_text,
+        "structured_review": structured_review
+    }
+
+
+@app.post("/review/incremental", dependencies=[Depends(admit_llm)])
+def review_code_incremental(request: IncrementalReviewRequest):
+    """
+    Review only the hunks that changed since `previous_code` (plus a few
+    lines of context) and merge the result with the cached findings for
+    the rest of the file. Falls back to a full review when there is
+    nothing cached for the previous version.
+    """
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    previous = cached_findings(request.previous_code, request.language)
+    new_lines = request.code.splitlines()
+
+    if previous is None:
+        result = review_code(CodeRequest(code=request.code, language=request.language))
+        return {**result, "mode": "full", "reviewed_lines": len(new_lines), "total_lines": len(new_lines)}
+
+    old_lines = request.previous_code.splitlines()
+    opcodes = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+
+    # Windows of the new file to re-review, as [start, end) line indexes
+    windows = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            continue
+        start = max(j1 - REVIEW_CONTEXT_LINES, 0)
+        end = min(max(j2, j1 + 1) + REVIEW_CONTEXT_LINES, len(new_lines))
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+
+    # Keep old findings that sit in unchanged code outside the windows
+    kept = []
+    for finding in previous:
+        if finding["line"] is None:
+            kept.append(finding)
+            continue
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal" and i1 < finding["line"] <= i2:
+                new_line = finding["line"] - i1 + j1
+                if not any(start < new_line <= end for start, end in windows):
+                    kept.append(move_finding(finding, new_line))
+                break
+
+    if not windows:
+        raw_review, structured_review = render_review(kept)
+        cache_findings(request.code, request.language, kept)
+        return {
+            "raw_review": raw_review,
+            "structured_review": structured_review,
+            "mode": "cached",
+            "reviewed_lines": 0,
+            "total_lines": len(new_lines)
+        }
+
+    hunks = "\n   ...\n".join(number_lines(new_lines[start:end], start + 1) for start, end in windows)
+    scope = (
+        "- You are shown only the changed parts of a larger file; review ONLY the lines shown.\n"
+        "- Do NOT report issues about code that is not shown.\n"
+    )
+
+    review_text = call_llm(
+        "review",
+        build_review_prompt(request.language, hunks, scope),
+        input_text=hunks,
+        validate=has_all_review_sections,
+        temperature=0.3,
+        max_tokens=output_budget("review", hunks)
+    )
+
+    findings = kept + parse_review_findings(review_text)
+    findings.sort(key=lambda finding: finding["line"] or 0)
+
+    cache_findings(request.code, request.language, findings)
+    raw_review, structured_review = render_review(findings)
+
+    return {
+        "raw_review": raw_review,
+        "structured_review": structured_review,
+        "mode": "incremental",
+        "reviewed_lines": sum(end - start for start, end in windows),
+        "total_lines": len(new_lines)
+    }
+
+
+
+# ================================
+# LOCAL SYNTAX CHECKS
+# ================================
+
+SYNTAX_CHECK_TIMEOUT = 5
+
+SQL_SYNTAX_ERRORS = ("syntax error", "incomplete input", "unrecognized token")
+
+
+def check_python_syntax(code: str):
+    try:
+        ast.parse(code)
+        return []
+    except SyntaxError as e:
+        return [{"line": e.lineno, "column": e.offset, "message": e.msg}]
+
+
+def check_javascript_syntax(code: str):
+    if shutil.which("node") is None:
+        return None
+
+    # ES module syntax is only accepted in .mjs files
+    is_module = re.search(r"^\s*(import|export)\b", code, re.MULTILINE)
+    file_name = "main.mjs" if is_module else "main.js"
+
+    with tempfile.TemporaryDirectory() as workdir:
+        file_path = os.path.join(workdir, file_name)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(code)
+
+        process = subprocess.run(
+            ["node", "--check", file_path],
+            capture_output=True,
+            text=True,
+            timeout=SYNTAX_CHECK_TIMEOUT
+        )
+
+    if process.returncode == 0:
+        return []
+
+    # node prints "<file>:<line>" followed by the source line, caret and error
+    line_match = re.search(rf"{re.escape(file_name)}:(\d+)", process.stderr)
+    error_match = re.search(r"^(\w*Error: .*)$", process.stderr, re.MULTILINE)
+
+    return [{
+        "line": int(line_match.group(1)) if line_match else None,
+        "column": None,
+        "message": error_match.group(1) if error_match else process.stderr.strip()
+    }]
+
+
+def gcc_syntax_checker(compiler: str, source_language: str):
+    def check(code: str):
+        if shutil.which(compiler) is None:
+            return None
+
+        process = subprocess.run(
+            [compiler, "-fsyntax-only", "-x", source_language, "-"],
+            input=code,
+            capture_output=True,
+            text=True,
+            timeout=SYNTAX_CHECK_TIMEOUT,
+            env={**os.environ, "LC_ALL": "C"}
+        )
+
+        return [
+            {"line": int(line), "column": int(column), "message": message}
+            for line, column, message in re.findall(
+                r"^<stdin>:(\d+):(\d+): (?:fatal )?error: (.*)$",
+                process.stderr,
+                re.MULTILINE
+            )
+        ] or ([] if process.returncode == 0 else [{"line": None, "column": None, "message": process.stderr.strip()}])
+
+    return check
+
+
+def check_sql_syntax(code: str):
+    """
+    EXPLAIN each statement against an in-memory SQLite database. Schema
+    statements are applied so later statements can see their tables;
+    missing tables or columns are not syntax errors and are ignored.
+    """
+    conn = sqlite3.connect(":memory:")
+    diagnostics = []
+    statement = ""
+    line = 1
+
+    def explain(statement: str, line: int):
+        try:
+            conn.execute(f"EXPLAIN {statement}")
+            if re.match(r"\s*(create|drop|alter)\b", statement, re.IGNORECASE):
+                conn.executescript(statement)
+        except sqlite3.Error as e:
+            if any(error in str(e) for error in SQL_SYNTAX_ERRORS):
+                diagnostics.append({"line": line, "column": None, "message": str(e)})
+
+    try:
+        # Split at each ";" that ends a complete statement rather than per
+        # line: execute() rejects two statements at once with an error
+        # that isn't a syntax error, which would hide the second one
+        number = 1
+        for char in code:
+            if not statement.strip():
+                line = number
+            statement += char
+            number += char == "\n"
+
+            if char != ";" or not sqlite3.complete_statement(statement):
+                continue
+
+            explain(statement, line)
+            statement = ""
+
+        # sqlite runs a final statement without ";" and ignores trailing
+        # comments, so check the remainder the same way. The newline keeps
+        # a trailing "-- comment" from swallowing the terminator.
+        remainder = re.sub(r"--[^\n]*|/\*.*?(\*/|$)", "", statement, flags=re.DOTALL)
+        if remainder.strip():
+            explain(statement + "\n;", line)
+    finally:
+        conn.close()
+
+    return diagnostics
+
+
+# language -> checker(code) returning a list of diagnostics, or None if
+# the checker isn't available on this server
+SYNTAX_CHECKERS = {
+    "python": check_python_syntax,
+    "javascript": check_javascript_syntax,
+    "c": gcc_syntax_checker("gcc", "c"),
+    "cpp": gcc_syntax_checker("g++", "c++"),
+    "sql": check_sql_syntax,
+}
+
+
+def check_syntax(code: str, language: str):
+    checker = SYNTAX_CHECKERS.get(language.lower())
+    started = time.perf_counter()
+
+    try:
+        diagnostics = checker(code) if checker else None
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("SYNTAX CHECK FAILED:", e)
+        diagnostics = None
+
+    return {
+        "checked": diagnostics is not None,
+        "valid": diagnostics == [] if diagnostics is not None else None,
+        "diagnostics": diagnostics or [],
+        "time_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+
+def format_diagnostics(diagnostics):
+    return "\n".join(
+        f"- Line {item['line']}: {item['message']}" if item["line"] else f"- {item['message']}"
+        for item in diagnostics
+    )
+
+
+@app.post("/syntax-check", dependencies=[Depends(admit_run)])
+def syntax_check(request: CodeRequest):
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    return check_syntax(request.code, request.language)
+
+
+def validate_with_llm(request: CodeRequest):
+    validation_prompt = f"""
+You are a strict code validator.
+
+Analyze the following {request.language} code.
+
+Answer ONLY with one word:
+VALID
+or
+INVALID
+
+INVALID means:
+- Syntax error
+- Runtime error
+- Logical error that prevents correct execution
+
+Do NOT explain.
+
+Code:
+{request.code}
+"""
+
+    return call_llm(
+        "validate",
+        validation_prompt,
+        input_text=request.code,
+        validate=lambda answer: answer.strip() in ("VALID", "INVALID"),
+        temperature=0,
+        max_tokens=10
+    ).strip()
+
+
+@app.post("/rewrite", dependencies=[Depends(admit_llm)])
+def rewrite_code(request: CodeRequest):
+
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    # =====================================================
+    # STEP 1: VALIDATION
+    # Local parser first; the LLM only for languages without one
+    # =====================================================
+
+    # Diagnostics are reported against the user's own line numbers
+    syntax = check_syntax(request.code, request.language)
+
+    if syntax["checked"] and not syntax["valid"]:
+        return {
+            "rewrite_result": "Code contains syntax errors. Please use the Debug feature.",
+            "diagnostics": syntax["diagnostics"]
+        }
+
+    code = compact_code("rewrite", request.code, request.language, syntax)
+
+    status = "VALID" if syntax["checked"] else validate_with_llm(CodeRequest(code=code, language=request.language))
+
+    # =====================================================
+    # STEP 2: IF INVALID → REDIRECT
+    # =====================================================
+
+    if status == "INVALID":
+        return {
+            "rewrite_result": "Code contains logical or runtime errors. Please use the Debug feature."
+        }
+
+    # =====================================================
+    # STEP 3: NORMAL REWRITE (FORMAT ONLY)
+    # =====================================================
+
+    rewrite_prompt = f"""
+You are a {request.language} code formatter.
+
+STRICT RULES:
+- ONLY improve formatting and readability.
+- Fix indentation.
+- Improve variable names.
+- DO NOT fix logic.
+- DO NOT optimize.
+- DO NOT add explanations.
+- Return ONLY formatted code.
+- Do NOT use markdown.
+
+Language: {request.language}
+
+Code:
+{code}
+"""
+
+    formatted_code = call_llm(
+        "rewrite",
+        rewrite_prompt,
+        input_text=code,
+        continuation_budget=CONTINUATION_TOKEN_BUDGET,
+        temperature=0.2,
+        max_tokens=output_budget("rewrite", code)
+    ).strip()
+
+    return {
+        "rewrite_result": formatted_code
+    }
+
+
+def build_debug_prompt(code: str, language: str, syntax=None):
+    # Give the model the exact parser errors instead of making it find them
+    syntax = syntax or check_syntax(code, language)
+    diagnostics = ""
+    if syntax["checked"] and not syntax["valid"]:
+        diagnostics = f"""
+Parser diagnostics (already verified, fix these):
+{format_diagnostics(syntax["diagnostics"])}
+"""
+
+    return f"""
+You are a senior {language} debugging expert.
+
+IMPORTANT RULES:
+- Check for syntax errors.
+- Check for runtime errors.
+- Check for logical bugs.
+- If the code has ANY issue:
+    1. First clearly list the errors found.
+    2. Then provide the corrected code.
+- If the code has NO issues at all, respond EXACTLY with:
+Your code is correct, no bugs found.
+- DO NOT optimize performance.
+- DO NOT redesign architecture.
+- DO NOT significantly refactor code.
+- Do NOT use markdown.
+- Do NOT wrap in triple backticks.
+
+Language: {language}
+{diagnostics}
+Code:
+{code}
+"""
+
+
+def compact_debug_code(code: str, language: str):
+    """
+    Compact code for the debug prompt with a single syntax check. Code
+    with parser errors is sent as written so the diagnostics' line
+    numbers match it.
+    """
+    syntax = check_syntax(code, language)
+    if syntax["checked"] and not syntax["valid"]:
+        return code, syntax
+    return compact_code("debug", code, language, syntax), syntax
+
+
+def parse_debug_result(result: str):
+    result = result.strip().replace("```", "").strip()
+
+    if result.lower() == "your code is correct, no bugs found.":
+        return {
+            "message": "Your code is correct, no bugs found."
+        }
+
+    # Split errors and fixed code
+    if "Corrected Code:" in result:
+        parts = result.split("Corrected Code:")
+        errors = parts[0].strip()
+        fixed_code = parts[1].strip()
+
+        return {
+            "errors": errors,
+            "fixed_code": fixed_code
+        }
+
+    return {
+        "fixed_code": result
+    }
+
+
+@app.post("/debug", dependencies=[Depends(admit_llm)])
+def debug_code(request: CodeRequest):
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    code, syntax = compact_debug_code(request.code, request.language)
+    prompt = build_debug_prompt(code, request.language, syntax)
+
+    result = call_llm(
+        "debug",
+        prompt,
+        input_text=code,
+        temperature=0.2,
+        max_tokens=output_budget("debug", code)
+    )
+
+    return parse_debug_result(result)
+
+
+
+def build_optimize_prompt(code: str, language: str):
+    return f"""
+You are a senior {language} performance optimization engineer.
+
+IMPORTANT:
+- Improve time complexity if possible.
+- Improve space complexity if possible.
+- Preserve functionality.
+- Do NOT add markdown.
+- Return ONLY a JSON object matching this JSON Schema:
+
+{json.dumps(OPTIMIZE_SCHEMA, indent=2)}
+
+Code:
+{code}
+"""
+
+
+def check_code_request(request: CodeRequest):
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+
+@app.post("/optimize", dependencies=[Depends(admit_llm)])
+def optimize_code(request: CodeRequest):
+    check_code_request(request)
+
+    code = compact_code("optimize", request.code, request.language)
+    prompt = build_optimize_prompt(code, request.language)
+
+    raw = call_llm(
+        "optimize",
+        prompt,
+        input_text=code,
+        validate=is_schema_output(OPTIMIZE_SCHEMA),
+        response_format={"type": "json_object"},
+        temperature=0.2,
+        max_tokens=output_budget("optimize", code)
+    ).strip()
+
+    parsed = repair_json(raw)
+
+    if isinstance(parsed, dict) and parsed.get("optimized_code"):
+        # Keep whatever fields the model did return
+        return {
+            "theoretical_explanation": "Explanation not generated.",
+            "before_time_complexity": "Unknown",
+            "before_space_complexity": "Unknown",
+            "after_time_complexity": "Unknown",
+            "after_space_complexity": "Unknown",
+            **parsed
+        }
+
+    # Fallback if model fails formatting
+    return {
+        "optimized_code": raw,
+        "theoretical_explanation": "Explanation not generated.",
+        "before_time_complexity": "Unknown",
+        "before_space_complexity": "Unknown",
+        "after_time_complexity": "Unknown",
+        "after_space_complexity": "Unknown"
+    }
+
+
+@app.post("/optimize/stream", dependencies=[Depends(admit_llm)])
+def optimize_code_stream(request: CodeRequest):
+    """
+    Server-sent events: one `field` event per JSON field as soon as the
+    model finishes it, then a `done` event with the full result.
+    """
+    check_code_request(request)
+
+    code = compact_code("optimize", request.code, request.language)
+    prompt = build_optimize_prompt(code, request.language)
+
+    def events():
+        parser = IncrementalJSONParser()
+        raw = ""
+
+        for chunk in stream_llm(
+            "optimize",
+            prompt,
+            input_text=code,
+            response_format={"type": "json_object"},
+            temperature=0.2,
+            max_tokens=output_budget("optimize", code)
+        ):
+            raw += chunk
+            for kind, key, value in parser.feed(chunk):
+                if kind == "field":
+                    yield sse_event("field", {"key": key, "value": value})
+
+        parsed = repair_json(raw)
+        if not matches_schema(parsed, OPTIMIZE_SCHEMA):
+            yield sse_event("error", {"error": "Model did not return valid JSON", "debug_output": raw})
+            return
+
+        yield sse_event("done", parsed)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# ================================
+# OPTIMIZATION VERIFICATION
+# ================================
+
+VERIFY_MIN_SIZE = 16
+VERIFY_MAX_SIZE = 1 << 20
+MAX_VERIFY_SIZES = 16
+# Stop growing a program's input once it takes this much CPU time
+VERIFY_TARGET_MS = 500
+VERIFY_BUDGET_SECONDS = 30
+GENERATOR_TIMEOUT = 5
+MAX_GENERATED_INPUT_CHARS = 16_000_000
+# Time above startup below this is mostly noise
+MIN_EXCESS_MS = 10
+
+# Upper bounds on the fitted log-log exponent for each growth class
+GROWTH_EXPONENTS = [
+    (0.5, "O(log n)"),
+    (1.15, "O(n)"),
+    (1.5, "O(n log n)"),
+    (2.5, "O(n^2)"),
+    (3.5, "O(n^3)"),
+]
+EXPONENTIAL_CLASS = "O(2^n)"
+
+COMPLEXITY_ALIASES = {
+    "1": "O(1)",
+    "logn": "O(log n)",
+    "n": "O(n)",
+    "nlogn": "O(n log n)",
+    "n^2": "O(n^2)",
+    "n*n": "O(n^2)",
+    "n^3": "O(n^3)",
+    "2^n": "O(2^n)",
+}
+
+GENERATOR_MAIN = """
+
+if __name__ == "__main__":
+    import sys
+    sys.stdout.write(str(generate(int(sys.argv[1]))))
+"""
+
+
+def build_input_generator_prompt(code: str, language: str):
+    return f"""
+You are a senior {language} performance engineer writing a benchmark.
+
+Write a Python 3 function `generate(n)` that returns the complete stdin
+text for the program below, sized so that the program's work grows with n.
+
+RULES:
+- Deterministic: seed any randomness with random.Random(n).
+- Standard library only.
+- Valid input for every n >= 1.
+- Output ONLY the Python code. No markdown. No explanations.
+
+Program:
+{code}
+"""
+
+
+def generate_input_generator(code: str, language: str):
+    result = call_llm(
+        "input_generator",
+        build_input_generator_prompt(code, language),
+        input_text=code,
+        temperature=0.2,
+        max_tokens=800
+    )
+    return re.sub(r"^```\w*\n?|```$", "", result.strip(), flags=re.MULTILINE).strip()
+
+
+def check_input_generator(generator: str):
+    try:
+        tree = ast.parse(generator)
+    except SyntaxError as e:
+        raise HTTPException(status_code=422, detail=f"Input generator is not valid Python: {e.msg}")
+
+    if not any(isinstance(node, ast.FunctionDef) and node.name == "generate" for node in tree.body):
+        raise HTTPException(status_code=422, detail="Input generator must define generate(n)")
+
+
+def generate_input(generator_path: str, workdir: str, size: int):
+    try:
+        process = subprocess.run(
+            ["python", generator_path, str(size)],
+            capture_output=True,
+            text=True,
+            timeout=GENERATOR_TIMEOUT,
+            cwd=workdir
+        )
+    except subprocess.TimeoutExpired:
+        return None, "Input generator timed out."
+
+    if process.returncode != 0:
+        return None, last_error_line(process.stderr) or "Input generator failed."
+
+    return process.stdout, ""
+
+
+def timed_run(command, workdir: str, stdin: str, timeout: float):
+    # The workdir is reused across sizes; a killed run writes no metrics,
+    # so the previous run's file must not be read in its place
+    try:
+        os.remove(os.path.join(workdir, RUN_METRICS))
+    except FileNotFoundError:
+        pass
+
+    runner = StreamedProcess(measured_command(command, workdir), workdir, stdin)
+    exit_code = runner.wait(timeout)
+    metrics = read_metrics(workdir) or {}
+
+    return {
+        "exit_code": exit_code,
+        "timed_out": runner.timed_out,
+        "cpu_ms": metrics.get("cpu_ms"),
+        "wall_ms": metrics.get("wall_ms"),
+        "peak_rss_kb": metrics.get("peak_rss_kb"),
+        "output": runner.stdout.text(),
+        "truncated_chars": runner.stdout.dropped,
+        "error": last_error_line(runner.stderr.text()) if exit_code else ""
+    }
+
+
+def normalize_output(run):
+    lines = run["output"].strip().splitlines()
+    return run["truncated_chars"], "\n".join(line.rstrip() for line in lines)
+
+
+def fit_growth(points):
+    """
+    Estimate the growth class from (size, cpu_ms) points.
+
+    The fastest run approximates process startup; the exponent k is the
+    least-squares slope of log(time - startup) against log(size), fitted
+    over the points that clearly exceed startup.
+    """
+    if not points:
+        return {"class": None, "exponent": None, "reason": "No completed runs"}
+
+    startup = min(time_ms for _, time_ms in points)
+    growing = [(size, time_ms - startup) for size, time_ms in points if time_ms - startup >= MIN_EXCESS_MS]
+
+    if len(growing) < 2:
+        return {
+            "class": None,
+            "exponent": None,
+            "reason": f"No measurable growth up to n={max(size for size, _ in points)}"
+        }
+
+    xs = [math.log(size) for size, _ in growing]
+    ys = [math.log(excess) for _, excess in growing]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    exponent = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+
+    growth = next((name for bound, name in GROWTH_EXPONENTS if exponent < bound), EXPONENTIAL_CLASS)
+
+    return {
+        "class": growth,
+        "exponent": round(exponent, 2),
+        "startup_ms": round(startup, 2),
+        "fitted_points": len(growing)
+    }
+
+
+def complexity_class(text: str):
+    """Map a model-written complexity like 'O(N²)' onto the growth classes fit_growth reports."""
+    text = text.lower().replace(" ", "").replace("²", "^2").replace("³", "^3").replace("**", "^")
+    match = re.search(r"o\((.*)\)", text)
+    body = match.group(1) if match else text
+    body = body.replace("log(n)", "logn").replace("log2n", "logn").replace("lgn", "logn").replace("*log", "log")
+    return COMPLEXITY_ALIASES.get(body)
+
+
+def verification_sizes(request: OptimizeVerifyRequest):
+    if request.sizes:
+        return sorted({int(size) for size in request.sizes if int(size) >= 1})[:MAX_VERIFY_SIZES]
+
+    sizes = []
+    size = VERIFY_MIN_SIZE
+    while size <= VERIFY_MAX_SIZE:
+        sizes.append(size)
+        size *= 2
+    return sizes
+
+
+def summarize_program(points, name: str, claimed: str, stopped: str):
+    completed = [
+        (point["size"], point[name]["cpu_ms"])
+        for point in points
+        if point[name] and point[name]["exit_code"] == 0 and not point[name]["timed_out"] and point[name]["cpu_ms"] is not None
+    ]
+    fit = fit_growth(completed)
+    claimed_class = complexity_class(claimed) if claimed else None
+
+    return {
+        "claimed_time_complexity": claimed or None,
+        "empirical_time_complexity": fit["class"],
+        "claim_matches": claimed_class == fit["class"] if claimed_class and fit["class"] else None,
+        "fit": fit,
+        "stopped": stopped
+    }
+
+
+@app.post("/optimize/verify", dependencies=[Depends(admit_llm), Depends(admit_run)])
+def verify_optimization(request: OptimizeVerifyRequest):
+    """
+    Run the original and optimized code on generated inputs of growing
+    size, check their outputs agree and fit the timings to a growth class.
+    Sizes double until each program takes VERIFY_TARGET_MS of CPU time.
+    """
+    if not request.code.strip() or not request.optimized_code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    language = request.language.lower()
+
+    if language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    if language == "sql":
+        raise HTTPException(status_code=400, detail="Verification not supported for SQL")
+
+    generator = request.input_generator or generate_input_generator(request.code, request.language)
+    check_input_generator(generator)
+
+    timeout = min(max(request.timeout, 0.1), RUN_TIMEOUT)
+    deadline = time.monotonic() + VERIFY_BUDGET_SECONDS
+
+    with tempfile.TemporaryDirectory() as workdir:
+        commands = {}
+        dirs = {}
+
+        for name, code in (("original", request.code), ("optimized", request.optimized_code)):
+            dirs[name] = os.path.join(workdir, name)
+            os.mkdir(dirs[name])
+
+            try:
+                command, compile_error = prepare_program(language, code, dirs[name])
+            except subprocess.TimeoutExpired:
+                command, compile_error = None, "Compilation timed out."
+
+            if command is None:
+                raise HTTPException(status_code=422, detail=f"The {name} code failed to compile: {compile_error}")
+
+            commands[name] = command
+
+        generator_path = os.path.join(workdir, "generate_input.py")
+        with open(generator_path, "w", encoding="utf-8") as f:
+            f.write(generator + GENERATOR_MAIN)
+
+        points = []
+        mismatch = None
+        stopped = {name: "max_size" for name in commands}
+
+        for size in verification_sizes(request):
+            # The optimized code keeps growing after the original hits its
+            # target so its own growth is measurable too
+            active = [name for name in commands if stopped[name] == "max_size"]
+            if not active:
+                break
+
+            if time.monotonic() > deadline:
+                for name in active:
+                    stopped[name] = "time_budget"
+                break
+
+            stdin, generator_error = generate_input(generator_path, workdir, size)
+            if stdin is None or len(stdin) > MAX_GENERATED_INPUT_CHARS:
+                for name in active:
+                    stopped[name] = generator_error or "input_too_large"
+                break
+
+            runs = {name: timed_run(commands[name], dirs[name], stdin, timeout) for name in active}
+            completed = {
+                name: run["exit_code"] == 0 and not run["timed_out"]
+                for name, run in runs.items()
+            }
+
+            outputs_match = None
+            speedup = None
+            if len(runs) == 2 and all(completed.values()):
+                outputs_match = normalize_output(runs["original"]) == normalize_output(runs["optimized"])
+                if runs["optimized"]["cpu_ms"]:
+                    speedup = round(runs["original"]["cpu_ms"] / runs["optimized"]["cpu_ms"], 2)
+
+            points.append({
+                "size": size,
+                "input_chars": len(stdin),
+                "outputs_match": outputs_match,
+                "speedup": speedup,
+                **{
+                    name: {key: value for key, value in runs[name].items() if key not in ("output", "truncated_chars")}
+                    if name in runs else None
+                    for name in commands
+                }
+            })
+
+            if outputs_match is False and mismatch is None:
+                mismatch = {
+                    "size": size,
+                    "input": stdin[:500],
+                    "original_output": runs["original"]["output"][:500],
+                    "optimized_output": runs["optimized"]["output"][:500]
+                }
+
+            for name, run in runs.items():
+                if run["timed_out"]:
+                    stopped[name] = "timed_out"
+                elif run["exit_code"] != 0:
+                    stopped[name] = "failed"
+                elif not request.sizes and (run["cpu_ms"] or 0) >= VERIFY_TARGET_MS:
+                    stopped[name] = "target_time"
+
+    compared = [point["outputs_match"] for point in points if point["outputs_match"] is not None]
+    speedups = [point for point in points if point["speedup"] is not None]
+
+    return {
+        "equivalent": all(compared) if compared else None,
+        "compared_sizes": len(compared),
+        "mismatch": mismatch,
+        "speedup": speedups[-1]["speedup"] if speedups else None,
+        "speedup_at_size": speedups[-1]["size"] if speedups else None,
+        "original": summarize_program(points, "original", request.before_time_complexity, stopped["original"]),
+        "optimized": summarize_program(points, "optimized", request.after_time_complexity, stopped["optimized"]),
+        "points": points,
+        "input_generator": generator
+    }
+
+
+@app.post("/convert", dependencies=[Depends(admit_llm)])
+def convert_code(request: ConvertRequest):
+
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.source_language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported source language")
+
+    if request.target_language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported target language")
+
+    code = compact_code("convert", request.code, request.source_language)
+
+    prompt = f"""
+You are an expert software engineer fluent in both {request.source_language} and {request.target_language}.
+
+Convert the following code from {request.source_language} to {request.target_language}.
+
+IMPORTANT RULES:
+- Preserve functionality exactly.
+- Use best practices of {request.target_language}.
+- Make it production-ready.
+- Do NOT add explanations.
+- Do NOT add markdown.
+- Do NOT wrap the output in triple backticks.
+- Return ONLY pure raw code.
+- No headings.
+- No labels.
+- No formatting text.
+
+Source Language: {request.source_language}
+Target Language: {request.target_language}
+
+Code:
+{code}
+"""
+
+
+    conversion = call_llm(
+        "convert",
+        prompt,
+        input_text=code,
+        continuation_budget=CONTINUATION_TOKEN_BUDGET,
+        temperature=0.2,
+        max_tokens=output_budget("convert", code)
+    )
+
+    return {
+        "conversion_result": conversion
+    }
+
+# ================================
+# CODE EXECUTION
+# ================================
+
+RUN_TIMEOUT = 10
+
+COMPILED_LANGUAGES = ["c", "cpp", "java"]
+
+
+def prepare_program(language: str, code: str, workdir: str):
+    """
+    Write code into workdir and compile it if needed.
+
+    Returns (run_command, compile_error).
+    """
+    if language == "python":
+        file_path = os.path.join(workdir, "main.py")
+        command = ["python", file_path]
+
+    elif language == "javascript":
+        file_path = os.path.join(workdir, "main.js")
+        command = ["node", file_path]
+
+    elif language == "java":
+        file_path = os.path.join(workdir, "Main.java")
+        code = re.sub(r"public\s+class\s+\w+", "public class Main", code, count=1)
+        compile_command = ["javac", file_path]
+        command = ["java", "-cp", workdir, "Main"]
+
+    elif language in ["c", "cpp"]:
+        file_path = os.path.join(workdir, f"main.{language}")
+        exe_path = os.path.join(workdir, "main.out")
+        compiler = "gcc" if language == "c" else "g++"
+        compile_command = [compiler, file_path, "-o", exe_path]
+        command = [exe_path]
+
+    else:
+        raise HTTPException(status_code=400, detail="Execution not supported for this language yet")
+
+    # Write code to file
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(code)
+
+    # Compile if needed
+    if language in COMPILED_LANGUAGES:
+        compile_process = subprocess.run(
+            compile_command,
+            capture_output=True,
+            text=True,
+            timeout=RUN_TIMEOUT
+        )
+
+        if compile_process.returncode != 0:
+            return None, compile_process.stderr
+
+    return command, ""
+
+
+def run_sql(code: str):
+    try:
+        conn = sqlite3.connect(":memory:")
+        cursor = conn.cursor()
+
+        # Execute full script (handles multiple statements)
+        cursor.executescript(code)
+
+        # Get last statement
+        statements = [s.strip() for s in code.strip().split(";") if s.strip()]
+        last_statement = statements[-1].lower()
+
+        # If last statement is SELECT, fetch results
+        if last_statement.startswith("select"):
+            cursor.execute(statements[-1])
+            rows = cursor.fetchall()
+            conn.close()
+            return {
+                "output": str(rows),
+                "error": ""
+            }
+
+        conn.commit()
+        conn.close()
+
+        return {
+            "output": "query executed successfully.",
+            "error": ""
+        }
+
+    except Exception as e:
+        return {
+            "output": "",
+            "error": str(e)
+        }
+
+
+MAX_OUTPUT_CHARS = int(os.getenv("MAX_OUTPUT_CHARS", "65536"))
+
+
+class OutputBuffer:
+    """Ring buffer that keeps the last max_chars of a stream."""
+
+    def __init__(self, max_chars: int = MAX_OUTPUT_CHARS):
+        self.max_chars = max_chars
+        self.chunks = deque()
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, text: str):
+        self.chunks.append(text)
+        self.size += len(text)
+
+        while self.size > self.max_chars:
+            overflow = self.size - self.max_chars
+            oldest = self.chunks[0]
+            if len(oldest) <= overflow:
+                self.chunks.popleft()
+                removed = len(oldest)
+            else:
+                self.chunks[0] = oldest[overflow:]
+                removed = overflow
+            self.size -= removed
+            self.dropped += removed
+
+    def text(self):
+        marker = f"[... {self.dropped} characters truncated ...]\n" if self.dropped else ""
+        return marker + "".join(self.chunks)
+
+
+STDBUF = shutil.which("stdbuf")
+
+
+class StreamedProcess:
+    """
+    Runs a command with stdin, reading stdout/stderr in background threads.
+
+    Output is retained in OutputBuffers. With forward=True every chunk is
+    also put on a bounded queue, so a slow consumer applies backpressure
+    to the process instead of growing server memory.
+    """
+
+    def __init__(self, command, workdir: str, stdin: str = "", forward: bool = False,
+                 output_chars: int = MAX_OUTPUT_CHARS):
+        env = None
+        if forward:
+            # Pipes make stdout block-buffered; streamed output should arrive
+            # line by line. stdbuf covers C/C++ stdio.
+            env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+            if STDBUF:
+                command = [STDBUF, "-oL", "-eL", *command]
+
+        self.process = subprocess.Popen(
+            command,
+            cwd=workdir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            start_new_session=True
+        )
+        self.stdout = OutputBuffer(output_chars)
+        self.stderr = OutputBuffer(output_chars)
+        self.events = queue.Queue(maxsize=256) if forward else None
+        self.timed_out = False
+        self.closed = False
+        self.marker_lock = Lock()
+
+        self.threads = [
+            Thread(target=self.feed, args=(stdin,), daemon=True),
+            Thread(target=self.pump, args=(self.process.stdout, "stdout", self.stdout), daemon=True),
+            Thread(target=self.pump, args=(self.process.stderr, "stderr", self.stderr), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def feed(self, stdin: str):
+        try:
+            if stdin:
+                self.process.stdin.write(stdin.encode())
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def pump(self, stream, name: str, buffer: OutputBuffer):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        for data in iter(lambda: stream.read1(4096), b""):
+            text = decoder.decode(data)
+            if text:
+                buffer.append(text)
+                self.forward((name, text))
+
+        self.forward((name, None))
+
+    def forward(self, event):
+        if self.events is None:
+            return
+
+        # Stop blocking once killed so a gone consumer can't hang this thread
+        while not self.closed:
+            try:
+                self.events.put(event, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+        # After a kill chunks are dropped, but the end-of-stream markers must
+        # still arrive or the consumer waits forever; evict chunks for room
+        if event[1] is not None:
+            return
+
+        with self.marker_lock:
+            markers = [event]
+            while markers:
+                try:
+                    self.events.put_nowait(markers[-1])
+                    markers.pop()
+                except queue.Full:
+                    try:
+                        evicted = self.events.get_nowait()
+                    except queue.Empty:
+                        continue
+                    if evicted[1] is None:
+                        markers.append(evicted)
+
+    def kill(self):
+        self.closed = True
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def wait(self, timeout: float = RUN_TIMEOUT):
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.timed_out = True
+            self.kill()
+            self.process.wait()
+
+        for thread in self.threads[1:]:
+            thread.join()
+
+        return self.process.returncode
+
+
+# ================================
+# RUN PROFILING
+# ================================
+
+PROFILE_TOP_ENTRIES = 20
+PYTHON_PROFILE = "profile.pstats"
+NODE_PROFILE = "profile.cpuprofile"
+
+# Synthetic V8 frames that aren't user code
+V8_META_FRAMES = {"(root)", "(program)", "(idle)"}
+
+RUN_METRICS = "metrics.json"
+
+# Forks the program from a small process and records its rusage. Linux
+# carries the forking process's peak RSS across exec, so waiting on the
+# program from the server directly would report the server's memory.
+RUSAGE_LAUNCHER = """
+import json, os, signal, sys, time
+
+started = time.monotonic()
+pid = os.fork()
+if pid == 0:
+    try:
+        os.execvp(sys.argv[2], sys.argv[2:])
+    finally:
+        os._exit(127)
+
+_, status, usage = os.wait4(pid, 0)
+with open(sys.argv[1], "w") as f:
+    json.dump({
+        "wall": time.monotonic() - started,
+        "user": usage.ru_utime,
+        "system": usage.ru_stime,
+        "maxrss": usage.ru_maxrss
+    }, f)
+
+code = os.waitstatus_to_exitcode(status)
+if code < 0:
+    # Die the same way so callers still see a negative return code
+    if -code not in (signal.SIGKILL, signal.SIGSTOP):
+        signal.signal(-code, signal.SIG_DFL)
+    os.kill(os.getpid(), -code)
+sys.exit(code)
+"""
+
 
-    result = response.choices[0].message.content.strip()
-    result = result.replace("```", "").strip()
+def profiled_command(language: str, command, workdir: str):
+    """Wrap a run command with the language's profiler, if it has one."""
+    if language == "python":
+        return [command[0], "-m", "cProfile", "-o", os.path.join(workdir, PYTHON_PROFILE), *command[1:]]
+
+    if language == "javascript":
+        return [command[0], "--cpu-prof", f"--cpu-prof-dir={workdir}", f"--cpu-prof-name={NODE_PROFILE}", *command[1:]]
+
+    return command
+
+
+def measured_command(command, workdir: str):
+    return [sys.executable, "-S", "-c", RUSAGE_LAUNCHER, os.path.join(workdir, RUN_METRICS), *command]
+
+
+def read_metrics(workdir: str):
+    # Missing when the run was killed (timeout or disconnect)
+    try:
+        with open(os.path.join(workdir, RUN_METRICS), encoding="utf-8") as f:
+            usage = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # ru_maxrss is KiB on Linux but bytes on macOS
+    peak_rss = usage["maxrss"]
+    if sys.platform == "darwin":
+        peak_rss //= 1024
 
     return {
-        "code": result
+        "wall_ms": round(usage["wall"] * 1000, 2),
+        "cpu_ms": round((usage["user"] + usage["system"]) * 1000, 2),
+        "user_ms": round(usage["user"] * 1000, 2),
+        "system_ms": round(usage["system"] * 1000, 2),
+        "peak_rss_kb": peak_rss
     }
 
-def build_comment_prompt(code: str, language: str):
-    return f"""
-You are a senior software engineer.
 
-Add clear and helpful comments to this {language} code.
+def profile_run(language: str, command, workdir: str):
+    """Command that runs under the language's profiler and records rusage."""
+    return measured_command(profiled_command(language, command, workdir), workdir)
 
-COMMENTING RULES:
-- Add a short comment above each function explaining its purpose.
-- Add short inline comments for important logic.
-- Do NOT add long documentation blocks.
-- Do NOT use JavaDoc or multi-line documentation.
-- Keep comments concise (1 line each).
-- Do NOT over-comment obvious lines.
-- Do NOT modify logic.
-- Preserve structure exactly.
-- Use correct comment syntax for {language}.
-- Output ONLY the full commented code.
-- No markdown.
-- No explanations outside code.
 
-Code:
-{code}
-"""
+def short_location(path: str, workdir: str, line: int):
+    path = path.removeprefix("file://")
+    if path.startswith(workdir):
+        path = os.path.relpath(path, workdir)
+    return f"{path}:{line}" if path else ""
+
+
+def python_profile(workdir: str, top: int = PROFILE_TOP_ENTRIES):
+    path = os.path.join(workdir, PYTHON_PROFILE)
+    if not os.path.exists(path):
+        return None
+
+    entries = []
+    for (file_name, line, function), (_, calls, self_time, total_time, _) in pstats.Stats(path).stats.items():
+        entries.append({
+            "function": function,
+            "location": short_location(file_name, workdir, line) if file_name != "~" else "built-in",
+            "calls": calls,
+            "self_ms": round(self_time * 1000, 3),
+            "total_ms": round(total_time * 1000, 3)
+        })
+
+    entries.sort(key=lambda entry: entry["self_ms"], reverse=True)
+    return {"profiler": "cProfile", "entries": entries[:top]}
+
+
+def node_profile(workdir: str, top: int = PROFILE_TOP_ENTRIES):
+    path = os.path.join(workdir, NODE_PROFILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, encoding="utf-8") as f:
+        profile = json.load(f)
+
+    nodes = {node["id"]: node for node in profile["nodes"]}
+
+    # Each sample's delta is attributed to the frame that was on top
+    self_us = {node_id: 0 for node_id in nodes}
+    for node_id, delta in zip(profile.get("samples", []), profile.get("timeDeltas", [])):
+        self_us[node_id] += max(delta, 0)
+
+    def frame_key(node):
+        frame = node["callFrame"]
+        # V8 line numbers are 0-based
+        return frame["functionName"] or "(anonymous)", frame["url"], frame["lineNumber"] + 1
+
+    # Subtree totals, children before parents
+    order = []
+    stack = [profile["nodes"][0]["id"]]
+    while stack:
+        node_id = stack.pop()
+        order.append(node_id)
+        stack.extend(nodes[node_id].get("children", []))
+
+    subtree_us = {}
+    for node_id in reversed(order):
+        subtree_us[node_id] = self_us[node_id] + sum(subtree_us[child] for child in nodes[node_id].get("children", []))
+
+    # A function's total counts its outermost frame only, so recursion isn't double counted
+    functions = {}
+    on_path = {}
+    stack = [(profile["nodes"][0]["id"], False)]
+    while stack:
+        node_id, leaving = stack.pop()
+        key = frame_key(nodes[node_id])
+
+        if leaving:
+            on_path[key] -= 1
+            continue
+
+        stats = functions.setdefault(key, {"self_us": 0, "total_us": 0})
+        stats["self_us"] += self_us[node_id]
+        if not on_path.get(key):
+            stats["total_us"] += subtree_us[node_id]
+
+        on_path[key] = on_path.get(key, 0) + 1
+        stack.append((node_id, True))
+        stack.extend((child, False) for child in nodes[node_id].get("children", []))
+
+    entries = [
+        {
+            "function": function,
+            "location": short_location(url, workdir, line),
+            "self_ms": round(stats["self_us"] / 1000, 3),
+            "total_ms": round(stats["total_us"] / 1000, 3)
+        }
+        for (function, url, line), stats in functions.items()
+        if function not in V8_META_FRAMES and stats["total_us"]
+    ]
+
+    entries.sort(key=lambda entry: entry["self_ms"], reverse=True)
+    return {"profiler": "v8", "entries": entries[:top]}
 
-@app.post("/comment")
-def add_comments(request: CommentRequest):
+
+PROFILE_READERS = {
+    "python": python_profile,
+    "javascript": node_profile,
+}
+
+
+def read_profile(language: str, workdir: str):
+    reader = PROFILE_READERS.get(language)
+    if reader is None:
+        return None
+
+    try:
+        return reader(workdir)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("PROFILE READ FAILED:", language, e)
+        return None
+
+
+def run_sql_measured(code: str):
+    # SQLite runs in-process, so only this thread's CPU time is attributable
+    started = time.monotonic()
+    cpu_started = time.thread_time()
+    result = run_sql(code)
+
+    result["metrics"] = {
+        "wall_ms": round((time.monotonic() - started) * 1000, 2),
+        "cpu_ms": round((time.thread_time() - cpu_started) * 1000, 2),
+        "peak_rss_kb": None
+    }
+    result["profile"] = None
+    return result
+
+
+@app.post("/run", dependencies=[Depends(admit_run)])
+def run_code(request: RunRequest):
 
     if not request.code.strip():
         raise HTTPException(status_code=400, detail="Code cannot be empty")
 
-    prompt = build_comment_prompt(
-        request.code,
-        request.language
-    )
+    language = request.language.lower()
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        max_tokens=1500
-    )
+    if language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
 
-    result = response.choices[0].message.content.strip()
-    result = result.replace("```", "").strip()
+    print("LANGUAGE RECEIVED:", request.language)
 
-    return {
-        "commented_code": result
-    }
+    if language == "sql":
+        return run_sql_measured(request.code) if request.profile else run_sql(request.code)
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            command, compile_error = prepare_program(language, request.code, workdir)
+
+            if command is None:
+                return {
+                    "output": "",
+                    "error": compile_error
+                }
 
+            if request.profile:
+                command = profile_run(language, command, workdir)
+
+            runner = StreamedProcess(command, workdir, request.stdin)
+            runner.wait(RUN_TIMEOUT)
+
+            result = {
+                "output": runner.stdout.text(),
+                "error": "Execution timed out." if runner.timed_out else runner.stderr.text()
+            }
+
+            if request.profile:
+                result["metrics"] = read_metrics(workdir)
+                result["profile"] = read_profile(language, workdir)
+
+        return result
+
+    except subprocess.TimeoutExpired:
+        return {
+            "output": "",
+            "error": "Execution timed out."
+        }
+
+    except Exception as e:
+        return {
+            "output": "",
+            "error": str(e)
+        }
+
+
+@app.post("/run/stream", dependencies=[Depends(admit_run)])
+async def run_code_stream(request: RunRequest, raw_request: Request):
+    """
+    Server-sent events: `stdout` / `stderr` events as the program prints,
+    then a `done` event with the exit code. The process is killed as soon
+    as the client disconnects.
+    """
 
-@app.post("/review")
-def review_code(request: CodeRequest):
     if not request.code.strip():
         raise HTTPException(status_code=400, detail="Code cannot be empty")
 
-    if request.language.lower() not in SUPPORTED_LANGUAGES:
+    language = request.language.lower()
+
+    if language not in SUPPORTED_LANGUAGES:
         raise HTTPException(status_code=400, detail="Unsupported language")
 
-    prompt = f"""
-You are a senior {request.language} software engineer and security expert.
+    async def events():
+        if language == "sql":
+            result = await run_in_threadpool(run_sql_measured if request.profile else run_sql, request.code)
+            if result["output"]:
+                yield sse_event("stdout", {"text": result["output"]})
+            if result["error"]:
+                yield sse_event("stderr", {"text": result["error"]})
+            done = {"exit_code": 1 if result["error"] else 0, "timed_out": False}
+            if request.profile:
+                done.update(metrics=result["metrics"], profile=None)
+            yield sse_event("done", done)
+            return
+
+        workdir = tempfile.mkdtemp()
+        runner = None
+
+        try:
+            try:
+                command, compile_error = await run_in_threadpool(prepare_program, language, request.code, workdir)
+            except subprocess.TimeoutExpired:
+                command, compile_error = None, "Compilation timed out."
 
-IMPORTANT:
-- Analyze the code strictly as {request.language}.
-- Do NOT assume Python unless explicitly provided.
-- Follow {request.language} best practices.
-- Detect language-specific vulnerabilities.
+            if command is None:
+                yield sse_event("stderr", {"text": compile_error})
+                yield sse_event("done", {"exit_code": None, "timed_out": False})
+                return
 
-Analyze the following code and return the review in EXACTLY this format:
+            if request.profile:
+                command = profile_run(language, command, workdir)
 
-## 🔴 Critical Issues
-- List critical bugs, security vulnerabilities, or crashes.
+            runner = StreamedProcess(command, workdir, request.stdin, forward=True)
+            deadline = time.monotonic() + RUN_TIMEOUT
+            open_streams = 2
 
-## 🟠 High Priority
-- List major performance or logic issues.
+            while open_streams:
+                if await raw_request.is_disconnected():
+                    print("RUN STREAM: client disconnected, killing process")
+                    return
 
-## 🟡 Medium Priority
-- List maintainability or readability issues.
+                if not runner.timed_out and time.monotonic() > deadline:
+                    runner.timed_out = True
+                    runner.kill()
 
-## 🟢 Low Priority
-- List minor improvements or style suggestions.
+                try:
+                    name, text = runner.events.get_nowait()
+                except queue.Empty:
+                    await asyncio.sleep(0.02)
+                    continue
 
-Language: {request.language}
+                if text is None:
+                    open_streams -= 1
+                    continue
 
-Code:
-{request.code}
-"""
+                yield sse_event(name, {"text": text})
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3,
-        max_tokens=800
-    )
+            exit_code = await run_in_threadpool(runner.wait, RUN_TIMEOUT)
 
-    review_text = response.choices[0].message.content
-    structured_review = parse_review_response(review_text)
+            done = {
+                "exit_code": exit_code,
+                "timed_out": runner.timed_out,
+                "truncated_chars": runner.stdout.dropped + runner.stderr.dropped
+            }
+            if request.profile:
+                done["metrics"] = read_metrics(workdir)
+                done["profile"] = await run_in_threadpool(read_profile, language, workdir)
 
-    return {
-        "raw_review": review_text,
-        "structured_review": structured_review
-    }
+            yield sse_event("done", done)
 
+        finally:
+            if runner is not None:
+                runner.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
 
+    return StreamingResponse(events(), media_type="text/event-stream")
 
-@app.post("/rewrite")
-def rewrite_code(request: CodeRequest):
 
-    if not request.code.strip():
+# ================================
+# EDITOR SESSION (WEBSOCKET)
+# ================================
+
+EDITOR_OPS = {"review": "llm", "debug": "llm", "comment": "llm", "run": "run"}
+EDITOR_SEND_TIMEOUT = 0.1
+EDITOR_KILL_GRACE = 1
+
+
+class Operation:
+    """
+    A cancellable unit of work on an editor session.
+
+    Work registers closers (closing the LLM stream, killing the process)
+    with on_cancel; cancel() runs them right away so a superseded
+    operation stops consuming tokens or CPU immediately.
+    """
+
+    def __init__(self, op_id, kind: str):
+        self.id = op_id
+        self.kind = kind
+        self.cancelled = Event()
+        self.closers = []
+        self.lock = Lock()
+
+    def on_cancel(self, closer):
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.closers.append(closer)
+                return
+        closer()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            closers, self.closers = self.closers, []
+
+        for closer in closers:
+            try:
+                closer()
+            except Exception as e:
+                print("CANCEL ERROR:", str(e))
+
+
+def check_editor_payload(payload: dict, kind: str):
+    code = payload.get("code") or ""
+    language = payload.get("language") or ""
+
+    if not code.strip():
         raise HTTPException(status_code=400, detail="Code cannot be empty")
 
-    if request.language.lower() not in SUPPORTED_LANGUAGES:
+    if kind != "comment" and language.lower() not in SUPPORTED_LANGUAGES:
         raise HTTPException(status_code=400, detail="Unsupported language")
 
-    # =====================================================
-    # STEP 1: VALIDATION CALL (PUT IT HERE 👇)
-    # =====================================================
+    return code, language
+
+
+def run_editor_llm(operation: Operation, payload: dict, emit):
+    code, language = check_editor_payload(payload, operation.kind)
+    if operation.kind == "debug":
+        compacted, syntax = compact_debug_code(code, language)
+    else:
+        compacted = compact_code(operation.kind, code, language)
+
+    if operation.kind == "review":
+        prompt = build_review_prompt(language, number_lines(compacted.splitlines()))
+        options = {"temperature": 0.3}
+    elif operation.kind == "debug":
+        prompt = build_debug_prompt(compacted, language, syntax)
+        options = {"temperature": 0.2}
+    else:
+        prompt = build_comment_prompt(compacted, language)
+        options = {"continuation_budget": CONTINUATION_TOKEN_BUDGET, "temperature": 0.2}
+
+    # Streamed rather than call_llm so a cancel closes the upstream stream
+    # at once. Identical in-flight calls aren't shared: one caller
+    # cancelling would cut off the others.
+    models = route_models(operation.kind, compacted)
+    for attempt, model in enumerate(models):
+        if attempt:
+            print(f"ROUTE {operation.kind}: {models[attempt - 1]} output failed validation, escalating")
+            emit("reset", {})
+
+        parts = []
+        for text in stream_llm(
+            operation.kind,
+            prompt,
+            input_text=compacted,
+            operation=operation,
+            model=model,
+            escalated=attempt > 0,
+            max_tokens=output_budget(operation.kind, compacted),
+            **options
+        ):
+            parts.append(text)
+            emit("chunk", {"text": text})
+
+        if operation.cancelled.is_set():
+            return None
+
+        result = "".join(parts)
+
+        # Same cascade as /review: the sections are checked once the stream ends
+        if operation.kind != "review" or has_all_review_sections(result):
+            break
+
+    if operation.kind == "review":
+        cache_findings(code, language, parse_review_findings(result))
+        return {
+            "raw_review": result,
+            "structured_review": parse_review_response(result)
+        }
 
-    validation_prompt = f"""
-You are a strict code validator.
+    if operation.kind == "debug":
+        return parse_debug_result(result)
 
-Analyze the following {request.language} code.
+    return {
+        "commented_code": result.replace("```", "").strip()
+    }
 
-Answer ONLY with one word:
-VALID
-or
-INVALID
 
-INVALID means:
-- Syntax error
-- Runtime error
-- Logical error that prevents correct execution
+def run_editor_program(operation: Operation, payload: dict, emit):
+    code, language = check_editor_payload(payload, "run")
+    language = language.lower()
+    profile = bool(payload.get("profile"))
+
+    if language == "sql":
+        result = run_sql_measured(code) if profile else run_sql(code)
+        if result["output"]:
+            emit("stdout", {"text": result["output"]})
+        if result["error"]:
+            emit("stderr", {"text": result["error"]})
+        done = {"exit_code": 1 if result["error"] else 0, "timed_out": False}
+        if profile:
+            done.update(metrics=result["metrics"], profile=None)
+        return done
+
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            command, compile_error = prepare_program(language, code, workdir)
+        except subprocess.TimeoutExpired:
+            command, compile_error = None, "Compilation timed out."
+
+        if operation.cancelled.is_set():
+            return None
+
+        if command is None:
+            emit("stderr", {"text": compile_error})
+            return {"exit_code": None, "timed_out": False}
+
+        if profile:
+            command = profile_run(language, command, workdir)
+
+        runner = StreamedProcess(command, workdir, payload.get("stdin") or "", forward=True)
+        operation.on_cancel(runner.kill)
+        deadline = time.monotonic() + RUN_TIMEOUT
+        open_streams = 2
+
+        while open_streams and not operation.cancelled.is_set():
+            if not runner.timed_out and time.monotonic() > deadline:
+                runner.timed_out = True
+                runner.kill()
+
+            # Never hold the run slot past the kill, even if a marker is lost
+            if runner.timed_out and time.monotonic() > deadline + EDITOR_KILL_GRACE:
+                break
 
-Do NOT explain.
+            try:
+                name, text = runner.events.get(timeout=0.05)
+            except queue.Empty:
+                continue
 
-Code:
-{request.code}
-"""
+            if text is None:
+                open_streams -= 1
+                continue
 
-    validation_response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": validation_prompt}],
-        temperature=0,
-        max_tokens=10
-    )
+            emit(name, {"text": text})
 
-    status = validation_response.choices[0].message.content.strip()
+        exit_code = runner.wait(RUN_TIMEOUT)
 
-    # =====================================================
-    # STEP 2: IF INVALID → REDIRECT
-    # =====================================================
+        if operation.cancelled.is_set():
+            return None
 
-    if status == "INVALID":
-        return {
-            "rewrite_result": "Code contains logical or runtime errors. Please use the Debug feature."
+        done = {
+            "exit_code": exit_code,
+            "timed_out": runner.timed_out,
+            "truncated_chars": runner.stdout.dropped + runner.stderr.dropped
         }
+        if profile:
+            done["metrics"] = read_metrics(workdir)
+            done["profile"] = read_profile(language, workdir)
 
-    # =====================================================
-    # STEP 3: NORMAL REWRITE (FORMAT ONLY)
-    # =====================================================
+    return done
 
-    rewrite_prompt = f"""
-You are a {request.language} code formatter.
 
-STRICT RULES:
-- ONLY improve formatting and readability.
-- Fix indentation.
-- Improve variable names.
-- DO NOT fix logic.
-- DO NOT optimize.
-- DO NOT add explanations.
-- Return ONLY formatted code.
-- Do NOT use markdown.
+@app.websocket("/ws/editor")
+async def editor_session(websocket: WebSocket):
+    """
+    One socket per editor, multiplexing review, debug, comment and run.
 
-Language: {request.language}
+    Client messages:
+        {"id": ..., "op": "review" | "debug" | "comment" | "run", "payload": {...}}
+        {"id": ..., "op": "cancel"}
 
-Code:
-{request.code}
-"""
+    A new operation cancels any running operation of the same kind unless
+    it sends "supersede": false. Server messages are
+    {"id": ..., "event": ..., "data": {...}} with events chunk, reset
+    (discard chunks so far; the op is retrying on a larger model), stdout,
+    stderr, result, error and cancelled.
+    """
+    await websocket.accept()
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": rewrite_prompt}],
-        temperature=0.2,
-        max_tokens=800
-    )
+    # Browsers can't set headers on a WebSocket, so the ID token comes in the query
+    client = websocket.client.host if websocket.client else "unknown"
+    try:
+        uid = await run_in_threadpool(verified_user, websocket.query_params.get("token"))
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    user = uid or f"ip:{client}"
+
+    loop = asyncio.get_running_loop()
+    outbox = asyncio.Queue(maxsize=256)
+    running = {}
+
+    async def send_messages():
+        while True:
+            await websocket.send_json(await outbox.get())
+
+    def forget(operation: Operation):
+        if running.get(operation.id) is operation:
+            del running[operation.id]
+
+    async def cancel(operation: Operation):
+        forget(operation)
+        operation.cancel()
+        await outbox.put({"id": operation.id, "event": "cancelled", "data": {}})
+
+    def work(operation: Operation, payload: dict):
+        def emit(event: str, data: dict):
+            # Bounded outbox: a slow client slows the producer down
+            future = asyncio.run_coroutine_threadsafe(
+                outbox.put({"id": operation.id, "event": event, "data": data}),
+                loop
+            )
+            while not operation.cancelled.is_set():
+                try:
+                    future.result(timeout=EDITOR_SEND_TIMEOUT)
+                    return
+                except TimeoutError:
+                    continue
+            future.cancel()
+
+        current_user.set(user)
+        kind = EDITOR_OPS[operation.kind]
+        started = None
+
+        try:
+            started = enter_admission(user, kind)
+            if operation.cancelled.is_set():
+                return
+
+            if kind == "run":
+                result = run_editor_program(operation, payload, emit)
+            else:
+                result = run_editor_llm(operation, payload, emit)
+
+            if result is not None:
+                emit("result", result)
+
+        except HTTPException as e:
+            error = {"status": e.status_code, "detail": e.detail}
+            retry_after = (e.headers or {}).get("Retry-After")
+            if retry_after:
+                error["retry_after"] = int(retry_after)
+            emit("error", error)
+
+        except Exception as e:
+            if not operation.cancelled.is_set():
+                print("EDITOR OP ERROR:", str(e))
+                emit("error", {"status": 500, "detail": str(e)})
+
+        finally:
+            if started is not None:
+                exit_admission(user, kind, started)
+            loop.call_soon_threadsafe(forget, operation)
+
+    sender = asyncio.create_task(send_messages())
 
-    formatted_code = response.choices[0].message.content.strip()
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                await outbox.put({"id": None, "event": "error", "data": {"status": 400, "detail": "Invalid JSON"}})
+                continue
+
+            if not isinstance(message, dict):
+                message = {}
+
+            op_id = message.get("id")
+            op = message.get("op")
+
+            if op == "cancel":
+                operation = running.get(op_id)
+                if operation is not None:
+                    await cancel(operation)
+                continue
+
+            if op_id is None or op not in EDITOR_OPS:
+                await outbox.put({"id": op_id, "event": "error", "data": {"status": 400, "detail": "Unknown operation"}})
+                continue
+
+            if op_id in running:
+                await outbox.put({"id": op_id, "event": "error", "data": {"status": 409, "detail": "Operation id already running"}})
+                continue
+
+            if message.get("supersede", True):
+                for other in list(running.values()):
+                    if other.kind == op:
+                        await cancel(other)
+
+            operation = Operation(op_id, op)
+            running[op_id] = operation
+            Thread(target=work, args=(operation, message.get("payload") or {}), daemon=True).start()
+
+    except WebSocketDisconnect:
+        pass
+
+    finally:
+        for operation in list(running.values()):
+            operation.cancel()
+        sender.cancel()
+
+
+# ================================
+# BATCHED EDGE CASE EXECUTION
+# ================================
+
+MAX_BATCH_CASES = 50
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+
+
+def case_stdin(case_input):
+    """Edge case inputs are fed on stdin: strings as-is, anything else as JSON."""
+    if isinstance(case_input, str):
+        return case_input
+    return json.dumps(case_input)
 
-    return {
-        "rewrite_result": formatted_code
-    }
 
+def last_error_line(stderr: str):
+    lines = [line for line in stderr.strip().splitlines() if line.strip()]
+    return lines[-1] if lines else ""
 
-@app.post("/debug")
-def debug_code(request: CodeRequest):
-    if not request.code.strip():
-        raise HTTPException(status_code=400, detail="Code cannot be empty")
 
-    if request.language.lower() not in SUPPORTED_LANGUAGES:
-        raise HTTPException(status_code=400, detail="Unsupported language")
-    
-    prompt = f"""
-You are a senior {request.language} debugging expert.
+# Function-call harnesses: load the code once, then call the target function
+# with each case's arguments, appending one JSON line per case to a results
+# file. argv: code_path function cases_path results_path start max_chars
+PYTHON_HARNESS = r'''
+import contextlib, importlib.util, inspect, io, json, sys, time, traceback
 
-IMPORTANT RULES:
-- Check for syntax errors.
-- Check for runtime errors.
-- Check for logical bugs.
-- If the code has ANY issue:
-    1. First clearly list the errors found.
-    2. Then provide the corrected code.
-- If the code has NO issues at all, respond EXACTLY with:
-Your code is correct, no bugs found.
-- DO NOT optimize performance.
-- DO NOT redesign architecture.
-- DO NOT significantly refactor code.
-- Do NOT use markdown.
-- Do NOT wrap in triple backticks.
+code_path, function_name, cases_path, results_path = sys.argv[1:5]
+start, max_chars = int(sys.argv[5]), int(sys.argv[6])
 
-Language: {request.language}
 
-Code:
-{request.code}
-"""
+class CappedOutput(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.kept = 0
+        self.dropped = 0
 
+    def write(self, text):
+        room = max(max_chars - self.kept, 0)
+        super().write(text[:room])
+        self.kept += min(len(text), room)
+        self.dropped += max(len(text) - room, 0)
+        return len(text)
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        max_tokens=900
-    )
+    def text(self):
+        marker = f"\n[... {self.dropped} characters truncated ...]" if self.dropped else ""
+        return self.getvalue() + marker
 
-    result = response.choices[0].message.content.strip()
-    result = result.replace("```", "").strip()
 
-    if result.lower() == "your code is correct, no bugs found.":
-        return {
-            "message": "Your code is correct, no bugs found."
-        }
+def arguments(function, value):
+    if isinstance(value, list):
+        return value, {}
+    if isinstance(value, dict):
+        try:
+            parameters = inspect.signature(function).parameters
+        except (TypeError, ValueError):
+            parameters = {}
+        if value and set(value) <= set(parameters):
+            return [], value
+        return list(value.values()), {}
+    return [value], {}
 
-    # Split errors and fixed code
-    if "Corrected Code:" in result:
-        parts = result.split("Corrected Code:")
-        errors = parts[0].strip()
-        fixed_code = parts[1].strip()
 
-        return {
-            "errors": errors,
-            "fixed_code": fixed_code
-        }
+results = open(results_path, "a", encoding="utf-8")
 
-    return {
-        "fixed_code": result
-    }
 
+def report(result):
+    results.write(json.dumps(result) + "\n")
+    results.flush()
 
 
-@app.post("/optimize")
-def optimize_code(request: CodeRequest):
-    if not request.code.strip():
-        raise HTTPException(status_code=400, detail="Code cannot be empty")
+with open(cases_path, encoding="utf-8") as f:
+    cases = json.load(f)
 
-    if request.language.lower() not in SUPPORTED_LANGUAGES:
-        raise HTTPException(status_code=400, detail="Unsupported language")
+spec = importlib.util.spec_from_file_location("solution", code_path)
+module = importlib.util.module_from_spec(spec)
+try:
+    with contextlib.redirect_stdout(CappedOutput()):
+        spec.loader.exec_module(module)
+    function = getattr(module, function_name)
+except BaseException as e:
+    report({"load_error": f"{type(e).__name__}: {e}"})
+    sys.exit(1)
 
-    prompt = f"""
-You are a senior {request.language} performance optimization engineer.
+report({"ready": True})
 
-IMPORTANT:
-- Improve time complexity if possible.
-- Improve space complexity if possible.
-- Preserve functionality.
-- Do NOT add markdown.
-- Return ONLY raw JSON.
+for index in range(start, len(cases)):
+    output = CappedOutput()
+    result = {"index": index, "return_value": None, "exception": "", "error": ""}
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            args, kwargs = arguments(function, cases[index])
+            result["return_value"] = repr(function(*args, **kwargs))[:max_chars]
+    except BaseException as e:
+        result["exception"] = f"{type(e).__name__}: {e}"[:max_chars]
+        result["error"] = traceback.format_exc(limit=-3)[-max_chars:]
+    result["time_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    result["output"] = output.text()
+    report(result)
+'''
+
+NODE_HARNESS = r'''
+const fs = require("fs");
+const util = require("util");
+const vm = require("vm");
+
+const [codePath, functionName, casesPath, resultsPath] = process.argv.slice(2, 6);
+const start = Number(process.argv[6]);
+const maxChars = Number(process.argv[7]);
+
+const report = (result) => fs.appendFileSync(resultsPath, JSON.stringify(result) + "\n");
+const cases = JSON.parse(fs.readFileSync(casesPath, "utf8"));
+
+function parameterNames(fn) {
+  const source = fn.toString();
+  const match = source.match(/^[^(]*\(([^)]*)\)/) || source.match(/^\s*(?:async\s*)?([\w$]+)\s*=>/);
+  if (!match) return [];
+  return match[1].split(",").map((name) => name.replace(/=.*$/, "").replace(/[.{}\[\]\s]/g, "")).filter(Boolean);
+}
+
+function argumentsFor(fn, value) {
+  if (Array.isArray(value)) return value;
+  if (value !== null && typeof value === "object") {
+    const names = parameterNames(fn);
+    const keys = Object.keys(value);
+    if (keys.length && keys.every((key) => names.includes(key))) {
+      return names.filter((name) => name in value).map((name) => value[name]);
+    }
+    return Object.values(value);
+  }
+  return [value];
+}
+
+function capture() {
+  const write = process.stdout.write;
+  const captured = { text: "", dropped: 0 };
+  process.stdout.write = (chunk) => {
+    const text = String(chunk);
+    const room = Math.max(maxChars - captured.text.length, 0);
+    captured.text += text.slice(0, room);
+    captured.dropped += Math.max(text.length - room, 0);
+    return true;
+  };
+  captured.restore = () => { process.stdout.write = write; };
+  return captured;
+}
+
+async function main() {
+  let fn;
+  const loading = capture();
+  try {
+    global.require = require;
+    global.module = { exports: {} };
+    global.exports = global.module.exports;
+    vm.runInThisContext(fs.readFileSync(codePath, "utf8"), { filename: codePath });
+    fn = vm.runInThisContext(functionName);
+  } catch (e) {
+    loading.restore();
+    report({ load_error: `${e && e.name}: ${e && e.message}` });
+    process.exit(1);
+  }
+  loading.restore();
+  report({ ready: true });
+
+  for (let index = start; index < cases.length; index++) {
+    const result = { index, return_value: null, exception: "", error: "" };
+    const output = capture();
+    const started = process.hrtime.bigint();
+    try {
+      let value = fn(...argumentsFor(fn, cases[index]));
+      if (value && typeof value.then === "function") value = await value;
+      result.return_value = util.inspect(value, { depth: 4 }).slice(0, maxChars);
+    } catch (e) {
+      result.exception = `${e && e.name}: ${e && e.message}`.slice(0, maxChars);
+      result.error = String((e && e.stack) || "").slice(0, maxChars);
+    }
+    output.restore();
+    result.time_ms = Number(process.hrtime.bigint() - started) / 1e6;
+    result.output = output.text + (output.dropped ? `\n[... ${output.dropped} characters truncated ...]` : "");
+    report(result);
+  }
+}
+
+main();
+'''
+
+HARNESSES = {
+    "python": (["python"], "harness.py", PYTHON_HARNESS, "main.py"),
+    "javascript": (["node"], "harness.js", NODE_HARNESS, "main.js"),
+}
+CASE_OUTPUT_CHARS = 8192
+HARNESS_POLL_SECONDS = 0.01
+
+
+def find_target_function(code: str, language: str):
+    """The last top-level function other than main, or None if there isn't one."""
+    if language == "python":
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            return None
+        names = [
+            node.name for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        ]
+
+    elif language == "javascript":
+        # ES modules can't be loaded as a script; run those as programs
+        if re.search(r"^\s*(import|export)\s", code, re.MULTILINE):
+            return None
+        names = [
+            declared or assigned
+            for declared, assigned in re.findall(
+                r"^(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)"
+                r"|^(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s*)?(?:function\b|\([^)]*\)\s*=>|[A-Za-z_$][\w$]*\s*=>)",
+                code,
+                re.MULTILINE
+            )
+        ]
 
-FORMAT:
+    else:
+        return None
 
-{{
-  "optimized_code": "...",
-  "theoretical_explanation": "...",
-  "before_time_complexity": "...",
-  "before_space_complexity": "...",
-  "after_time_complexity": "...",
-  "after_space_complexity": "..."
-}}
+    names = [name for name in names if name != "main"]
+    return names[-1] if names else None
 
-Code:
-{request.code}
-"""
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        max_tokens=1200
-    )
+def read_results(path: str, offset: int):
+    """Complete JSON lines appended to path since offset."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
 
-    raw = response.choices[0].message.content.strip()
+    complete = data[:data.rfind("\n") + 1]
+    return [json.loads(line) for line in complete.splitlines() if line], offset + len(complete.encode())
 
-    # Clean markdown if model adds it
-    raw = raw.replace("```json", "").replace("```", "").strip()
 
-    try:
-        return json.loads(raw)
-    except Exception:
-        # Fallback if model fails formatting
-        return {
-            "optimized_code": raw,
-            "theoretical_explanation": "Explanation not generated.",
-            "before_time_complexity": "Unknown",
-            "before_space_complexity": "Unknown",
-            "after_time_complexity": "Unknown",
-            "after_space_complexity": "Unknown"
-        }
+def run_harness(language: str, workdir: str, function: str, cases, group: int, timeout: float):
+    """
+    Run every case through one harness process. A case that hangs or kills
+    the process is recorded, and a fresh harness resumes after it.
 
+    Returns None if the code couldn't be loaded at all.
+    """
+    interpreter, harness_name, _, code_name = HARNESSES[language]
+    cases_path = os.path.join(workdir, f"cases-{group}.json")
+    with open(cases_path, "w", encoding="utf-8") as f:
+        json.dump(cases, f)
+
+    results = {}
+    position = 0
+    attempt = 0
+
+    while position < len(cases):
+        results_path = os.path.join(workdir, f"results-{group}-{attempt}.jsonl")
+        attempt += 1
+        runner = StreamedProcess(
+            [
+                *interpreter, os.path.join(workdir, harness_name), os.path.join(workdir, code_name),
+                function, cases_path, results_path, str(position), str(CASE_OUTPUT_CHARS)
+            ],
+            workdir,
+            output_chars=CASE_OUTPUT_CHARS
+        )
+
+        offset = 0
+        ready = False
+        # Loading the code gets the full run timeout; each case gets `timeout`
+        deadline = time.monotonic() + RUN_TIMEOUT
+        failure = None
+
+        while True:
+            lines, offset = read_results(results_path, offset)
+            for line in lines:
+                if "load_error" in line:
+                    failure = {"exception": line["load_error"], "error": line["load_error"], "exit_code": 1, "timed_out": False}
+                elif line.get("ready"):
+                    ready = True
+                else:
+                    results[line["index"]] = line
+                    position = line["index"] + 1
+                deadline = time.monotonic() + timeout
+
+            if failure or position >= len(cases):
+                break
+
+            if runner.process.poll() is not None:
+                # Exited mid-case: sys.exit, a crash or an uncatchable error
+                runner.wait(0)
+                lines, offset = read_results(results_path, offset)
+                if lines:
+                    continue
+                stderr = runner.stderr.text()
+                failure = {
+                    "exception": last_error_line(stderr) or f"Process exited with code {runner.process.returncode}",
+                    "error": stderr,
+                    "exit_code": runner.process.returncode,
+                    "timed_out": False
+                }
+                break
 
-@app.post("/convert")
-def convert_code(request: ConvertRequest):
+            if time.monotonic() > deadline:
+                failure = {"exception": "", "error": "Execution timed out.", "exit_code": None, "timed_out": True}
+                break
 
-    if not request.code.strip():
-        raise HTTPException(status_code=400, detail="Code cannot be empty")
+            time.sleep(HARNESS_POLL_SECONDS)
 
-    if request.source_language.lower() not in SUPPORTED_LANGUAGES:
-        raise HTTPException(status_code=400, detail="Unsupported source language")
+        runner.kill()
+        runner.wait(0)
 
-    if request.target_language.lower() not in SUPPORTED_LANGUAGES:
-        raise HTTPException(status_code=400, detail="Unsupported target language")
+        if failure is None:
+            continue
 
-    prompt = f"""
-You are an expert software engineer fluent in both {request.source_language} and {request.target_language}.
+        if not ready:
+            # Usually a program that reads stdin at the top level; the
+            # caller runs it as a program instead
+            print(f"HARNESS LOAD FAILED ({function}): {failure['exception']}")
+            return None
 
-Convert the following code from {request.source_language} to {request.target_language}.
+        results[position] = {"index": position, "return_value": None, "output": runner.stdout.text(), **failure}
+        position += 1
 
-IMPORTANT RULES:
-- Preserve functionality exactly.
-- Use best practices of {request.target_language}.
-- Make it production-ready.
-- Do NOT add explanations.
-- Do NOT add markdown.
-- Do NOT wrap the output in triple backticks.
-- Return ONLY pure raw code.
-- No headings.
-- No labels.
-- No formatting text.
+    return results
 
-Source Language: {request.source_language}
-Target Language: {request.target_language}
 
-Code:
-{request.code}
-"""
+def run_function_cases(language: str, code: str, function: str, cases, timeout: float):
+    """
+    Split the cases across BATCH_WORKERS harness processes. Returns None
+    if the code can't be loaded as a module.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        _, harness_name, harness_source, code_name = HARNESSES[language]
+        with open(os.path.join(workdir, harness_name), "w", encoding="utf-8") as f:
+            f.write(harness_source)
+        with open(os.path.join(workdir, code_name), "w", encoding="utf-8") as f:
+            f.write(code)
+
+        inputs = [case.get("input") if isinstance(case, dict) else case for case in cases]
+        workers = min(BATCH_WORKERS, len(cases))
+        groups = [list(range(len(cases)))[group::workers] for group in range(workers)]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            group_results = list(pool.map(
+                lambda group: run_harness(language, workdir, function, [inputs[index] for index in groups[group]], group, timeout),
+                range(workers)
+            ))
+
+    if any(results is None for results in group_results):
+        return None
+
+    results = []
+    for index, case in enumerate(cases):
+        group = index % workers
+        result = group_results[group].get(index // workers, {})
+        case = case if isinstance(case, dict) else {"input": case}
+        results.append({
+            "input": case.get("input"),
+            "expected_behavior": case.get("expected_behavior", ""),
+            "return_value": result.get("return_value"),
+            "output": result.get("output", ""),
+            "error": result.get("error", ""),
+            "exception": result.get("exception", ""),
+            "exit_code": result.get("exit_code", 0),
+            "timed_out": result.get("timed_out", False),
+            "time_ms": result.get("time_ms")
+        })
 
+    return results
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        max_tokens=1000
-    )
+
+def run_case(command, workdir, case, timeout):
+    """Run a whole program once with the case's input on stdin."""
+    if not isinstance(case, dict):
+        case = {"input": case}
+
+    started = time.perf_counter()
+    runner = StreamedProcess(command, workdir, case_stdin(case.get("input", "")), output_chars=CASE_OUTPUT_CHARS)
+    exit_code = runner.wait(timeout)
+    stderr = runner.stderr.text()
 
     return {
-        "conversion_result": response.choices[0].message.content
+        "input": case.get("input"),
+        "expected_behavior": case.get("expected_behavior", ""),
+        "return_value": None,
+        "output": runner.stdout.text(),
+        "error": "Execution timed out." if runner.timed_out else stderr,
+        "exception": last_error_line(stderr) if exit_code != 0 and not runner.timed_out else "",
+        "exit_code": None if runner.timed_out else exit_code,
+        "timed_out": runner.timed_out,
+        "time_ms": round((time.perf_counter() - started) * 1000, 2)
     }
 
-@app.post("/run")
-def run_code(request: RunRequest):
+
+@app.post("/edge-cases/run", dependencies=[Depends(admit_run)])
+def run_edge_cases(request: EdgeCaseRunRequest):
+    """
+    Run every edge case against the code with a per-case timeout.
+
+    Python and JavaScript code that defines a function is loaded once per
+    worker by a harness that calls the function with each case's input.
+    Anything else, including code that fails to load that way (say it reads
+    stdin at the top level), is compiled once and run as a program per
+    case, with the input on stdin.
+    """
 
     if not request.code.strip():
         raise HTTPException(status_code=400, detail="Code cannot be empty")
@@ -699,147 +4926,64 @@ def run_code(request: RunRequest):
     if language not in SUPPORTED_LANGUAGES:
         raise HTTPException(status_code=400, detail="Unsupported language")
 
-    try:
-        # Create temporary file
-        file_id = str(uuid.uuid4())
-        print("LANGUAGE RECEIVED:", request.language)
-        if language == "python":
-            file_path = f"{file_id}.py"
-            command = ["python", file_path]
-
-        elif language == "javascript":
-            file_path = f"{file_id}.js"
-            command = ["node", file_path]
-
-        elif language == "java":
-            file_path = f"{file_id}.java"
-            class_name = "Main"
-            request.code = request.code.replace("public class", f"public class {class_name}")
-            command = ["javac", file_path]
-
-        elif language == "c":
-            file_path = f"{file_id}.c"
-            exe_path = f"{file_id}.out"
-            command = ["gcc", file_path, "-o", exe_path]
-
-        elif language == "cpp":
-            file_path = f"{file_id}.cpp"
-            exe_path = f"{file_id}.out"
-            command = ["g++", file_path, "-o", exe_path]
-        elif language == "sql":
-            import sqlite3
-
-            try:
-                conn = sqlite3.connect(":memory:")
-                cursor = conn.cursor()
-
-                # Execute full script (handles multiple statements)
-                cursor.executescript(request.code)
-
-                # Get last statement
-                statements = [s.strip() for s in request.code.strip().split(";") if s.strip()]
-                last_statement = statements[-1].lower()
-
-                # If last statement is SELECT, fetch results
-                if last_statement.startswith("select"):
-                    cursor.execute(statements[-1])
-                    rows = cursor.fetchall()
-                    conn.close()
-                    return {
-                        "output": str(rows),
-                        "error": ""
-                    }
-
-                conn.commit()
-                conn.close()
-
-                return {
-                    "output": "query executed successfully.",
-                    "error": ""
-                }
-
-            except Exception as e:
-                return {
-                    "output": "",
-                    "error": str(e)
-                }
+    if language == "sql":
+        raise HTTPException(status_code=400, detail="Edge case execution not supported for SQL")
 
+    if not request.edge_test_cases:
+        raise HTTPException(status_code=400, detail="No edge cases provided")
 
+    if len(request.edge_test_cases) > MAX_BATCH_CASES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_CASES} edge cases per run")
 
-        else:
-            raise HTTPException(status_code=400, detail="Execution not supported for this language yet")
+    timeout = min(max(request.timeout, 0.1), RUN_TIMEOUT)
+    started = time.perf_counter()
 
-        # Write code to file
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(request.code)
-
-        # Compile if needed
-        if language in ["c", "cpp"]:
-            compile_process = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+    function = None
+    if language in HARNESSES:
+        function = request.function or find_target_function(request.code, language)
 
-            if compile_process.returncode != 0:
-                return {
-                    "output": "",
-                    "error": compile_process.stderr
-                }
+    if function:
+        if not re.fullmatch(r"[A-Za-z_$][\w$]*", function):
+            raise HTTPException(status_code=400, detail="Invalid function name")
 
-            run_process = subprocess.run(
-                [f"./{exe_path}"],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+        results = run_function_cases(language, request.code, function, request.edge_test_cases, timeout)
 
-        elif language == "java":
-            compile_process = subprocess.run(
-                ["javac", file_path],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+        if results is not None:
+            return {
+                "mode": "function",
+                "function": function,
+                "compile_error": "",
+                "compile_time_ms": 0,
+                "total_time_ms": round((time.perf_counter() - started) * 1000, 2),
+                "results": results
+            }
 
-            if compile_process.returncode != 0:
-                return {
-                    "output": "",
-                    "error": compile_process.stderr
-                }
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            command, compile_error = prepare_program(language, request.code, workdir)
+        except subprocess.TimeoutExpired:
+            return {"mode": "program", "compile_error": "Compilation timed out.", "results": []}
 
-            run_process = subprocess.run(
-                ["java", class_name],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+        if command is None:
+            return {"mode": "program", "compile_error": compile_error, "results": []}
 
-        else:
-            run_process = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+        compile_ms = round((time.perf_counter() - started) * 1000, 2)
 
-        return {
-            "output": run_process.stdout,
-            "error": run_process.stderr
-        }
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+            results = list(pool.map(
+                lambda case: run_case(command, workdir, case, timeout),
+                request.edge_test_cases
+            ))
 
-    except subprocess.TimeoutExpired:
-        return {
-            "output": "",
-            "error": "Execution timed out."
-        }
+    return {
+        "mode": "program",
+        "function": None,
+        "compile_error": "",
+        "compile_time_ms": compile_ms,
+        "total_time_ms": round((time.perf_counter() - started) * 1000, 2),
+        "results": results
+    }
 
-    except Exception as e:
-        return {
-            "output": "",
-            "error": str(e)
-        }
 
 def detect_tech_stack(files):
     tech_stack = []
@@ -895,50 +5039,256 @@ def generate_project_summary(tech_stack, files):
     Explain in 4-5 lines what this project likely does.
     """
 
-    response = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=[{"role": "user", "content": prompt}]
-    )
+    return call_llm("summary", prompt, input_text=prompt)
 
-    return response.choices[0].message.content
 
+# ================================
+# WORKSPACE INGESTION JOBS
+# ================================
 
-@app.post("/create-workspace")
-def create_workspace(data: WorkspaceCreate):
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+FILE_BATCH_SIZE = 400
 
-    files = fetch_repo_files(data.repo_url)
-    tech_stack = detect_tech_stack(files)
-    summary = generate_project_summary(tech_stack, files)
+ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+
+cancel_lock = Lock()
+cancelled_jobs = set()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_ref(job_id: str):
+    return db.collection("jobs").document(job_id)
+
+
+def make_job_id(data: WorkspaceCreate):
+    key = data.idempotency_key or f"{data.name}|{data.repo_url}"
+    return hashlib.sha256(f"{data.user_id}|{key}".encode()).hexdigest()[:20]
+
+
+def file_doc_id(path: str):
+    return hashlib.sha1(path.encode()).hexdigest()
 
-    workspace_ref = db.collection("users") \
-                      .document(data.user_id) \
-                      .collection("workspaces") \
-                      .document()
 
-    workspace_ref.set({
+def update_job(job_id: str, **fields):
+    fields["updated_at"] = datetime.utcnow()
+    job_ref(job_id).update(fields)
+
+
+def check_cancelled(job_id: str, poll: bool = False):
+    """
+    Raise JobCancelled if the job was cancelled. The in-process flag is
+    checked on every call; poll=True also reads the persisted flag, for
+    cancellations received by another server process.
+    """
+    with cancel_lock:
+        if job_id in cancelled_jobs:
+            raise JobCancelled()
+
+    if poll and job_ref(job_id).get().to_dict().get("cancel_requested"):
+        raise JobCancelled()
+
+
+@firestore.transactional
+def claim_job(transaction, ref, data: WorkspaceCreate):
+    """Create the job, or reuse it; returns (job, should_enqueue)."""
+    snapshot = ref.get(transaction=transaction)
+
+    if snapshot.exists:
+        job = snapshot.to_dict()
+        # Queued, running and completed jobs are returned as they are,
+        # unless the completed workspace has since been deleted
+        if job["status"] in ("queued", "running"):
+            return job, False
+        if job["status"] == "completed" and workspace_doc_ref(job["user_id"], ref.id).get(transaction=transaction).exists:
+            return job, False
+
+    job = {
+        "user_id": data.user_id,
         "name": data.name,
         "repo_url": data.repo_url,
-        "tech_stack": tech_stack,
-        "project_summary": summary,
-        "created_at": datetime.utcnow()
-    })
+        "workspace_id": ref.id,
+        "status": "queued",
+        "progress": {"files_listed": 0, "files_stored": 0, "summary_done": False},
+        "error": None,
+        "cancel_requested": False,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }
+    transaction.set(ref, job)
+    return job, True
 
-    # ✅ SAVE FILES INTO SUBCOLLECTION
-    for file in files:
-        workspace_ref.collection("files").add({
-            "file_name": file.get("name"),
-            "path": file.get("path"),
-            "download_url": file.get("download_url"),
-            "type": file.get("type")
-        })
+
+def ingest_workspace(job_id: str):
+    job = job_ref(job_id).get().to_dict()
+
+    workspace_ref = db.collection("users") \
+                      .document(job["user_id"]) \
+                      .collection("workspaces") \
+                      .document(job["workspace_id"])
+
+    try:
+        check_cancelled(job_id, poll=True)
+        update_job(job_id, status="running")
+
+        # Pin the listing to one commit so artifacts keyed by it match the files
+        commit_sha = fetch_head_sha(job["repo_url"])
+        files = fetch_repo_files(job["repo_url"], ref=commit_sha)
+        tech_stack = detect_tech_stack(files)
+        update_job(job_id, **{"progress.files_listed": len(files)})
+        check_cancelled(job_id, poll=True)
+
+        workspace_ref.set({
+            "name": job["name"],
+            "repo_url": job["repo_url"],
+            "tech_stack": tech_stack,
+            "commit_sha": commit_sha,
+            "created_at": job["created_at"]
+        }, merge=True)
+
+        # Files stored by an earlier attempt keep their blob reference
+        existing = {
+            doc.id: doc.to_dict().get("blob_sha")
+            for doc in workspace_ref.collection("files").stream()
+        }
+
+        batch = db.batch()
+        pending = 0
+        stored = 0
+
+        for file in files:
+            check_cancelled(job_id)
+
+            doc_id = file_doc_id(file["path"])
+            file_ref = workspace_ref.collection("files").document(doc_id)
+            file_doc = {
+                "file_name": file.get("name"),
+                "path": file.get("path"),
+                "download_url": file.get("download_url"),
+                "size": file.get("size", 0),
+                "type": file.get("type")
+            }
+            stored += 1
+
+            if doc_id in existing and existing[doc_id] in (file.get("sha"), None):
+                # Reference unchanged; the doc write can be batched
+                batch.set(file_ref, {**file_doc, "blob_sha": existing[doc_id]})
+                pending += 1
+            else:
+                # A new reference is committed together with its doc
+                store_file(file, file_ref, file_doc)
+
+            if pending >= FILE_BATCH_SIZE:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+
+            if stored % FILE_BATCH_SIZE == 0:
+                update_job(job_id, **{"progress.files_stored": stored})
+                check_cancelled(job_id, poll=True)
+
+        if pending:
+            batch.commit()
+        update_job(job_id, **{"progress.files_stored": stored})
+        check_cancelled(job_id, poll=True)
+
+        build_workspace_index(job["user_id"], job["workspace_id"])
+        check_cancelled(job_id)
+
+        # Shared per repo: another workspace of the same commit reuses it
+        summary = cached_artifact(
+            repo_ref(job["repo_url"]),
+            "summary",
+            commit_sha,
+            lambda: generate_project_summary(tech_stack, files)
+        )
+        workspace_ref.update({"project_summary": summary})
+
+        update_job(
+            job_id,
+            status="completed",
+            result={"workspace_id": workspace_ref.id, "tech_stack": tech_stack, "summary": summary},
+            **{"progress.summary_done": True}
+        )
+
+    except JobCancelled:
+        print("INGEST CANCELLED:", job_id)
+        if workspace_ref.get().exists:
+            delete_workspace(job["user_id"], job["workspace_id"])
+        update_job(job_id, status="cancelled")
+
+    except Exception as e:
+        print("INGEST FAILED:", job_id, e)
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        update_job(job_id, status="failed", error=detail)
+
+    finally:
+        with cancel_lock:
+            cancelled_jobs.discard(job_id)
+
+
+@app.on_event("startup")
+def resume_ingest_jobs():
+    # Jobs interrupted by a restart are picked up again; ingestion is idempotent
+    for status in ("queued", "running"):
+        for job in db.collection("jobs").where("status", "==", status).stream():
+            print("RESUMING INGEST:", job.id)
+            ingest_pool.submit(ingest_workspace, job.id)
+
+
+@app.post("/create-workspace")
+def create_workspace(data: WorkspaceCreate):
+
+    job_id = make_job_id(data)
+    job, should_enqueue = claim_job(db.transaction(), job_ref(job_id), data)
+
+    if should_enqueue:
+        with cancel_lock:
+            cancelled_jobs.discard(job_id)
+        ingest_pool.submit(ingest_workspace, job_id)
 
     return {
-        "workspace_id": workspace_ref.id,
-        "tech_stack": tech_stack,
-        "summary": summary
+        "job_id": job_id,
+        "workspace_id": job["workspace_id"],
+        "status": job["status"]
     }
 
 
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+
+    snapshot = job_ref(job_id).get()
+
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    job = snapshot.to_dict()
+    job["id"] = job_id
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+
+    snapshot = job_ref(job_id).get()
+
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    status = snapshot.to_dict()["status"]
+
+    if status not in ("queued", "running"):
+        return {"job_id": job_id, "status": status}
+
+    with cancel_lock:
+        cancelled_jobs.add(job_id)
+    update_job(job_id, cancel_requested=True)
+
+    return {"job_id": job_id, "status": "cancelling"}
+
+
 @app.get("/user/{user_id}/workspaces")
 def get_user_workspaces(user_id: str):
 
@@ -956,35 +5306,45 @@ def get_user_workspaces(user_id: str):
 
     return result
 
-@app.post("/generate-docs")
+@app.post("/generate-docs", dependencies=[Depends(admit_llm)])
 def generate_docs(data: DocumentationRequest):
 
-    workspace = db.collection("users") \
-                  .document(data.user_id) \
-                  .collection("workspaces") \
-                  .document(data.workspace_id) \
-                  .get() \
-                  .to_dict()
+    workspace_ref = db.collection("users") \
+                      .document(data.user_id) \
+                      .collection("workspaces") \
+                      .document(data.workspace_id)
+
+    workspace = workspace_ref.get().to_dict()
 
     if not workspace:
         return {"error": "Workspace not found"}
 
-    prompt = f"""
+    # The workspace doc exists while ingestion is still writing the summary
+    if not workspace.get("project_summary"):
+        raise HTTPException(status_code=409, detail="Workspace is still being ingested")
+
+    def generate():
+        prompt = f"""
     Project Summary:
     {workspace['project_summary']}
 
     Tech Stack:
-    {workspace['tech_stack']}
+    {workspace.get('tech_stack', [])}
 
     Generate {data.doc_type} documentation for this project.
     """
 
-    response = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=[{"role": "user", "content": prompt}]
+        return call_llm("docs", prompt, input_text=prompt)
+
+    documentation = cached_artifact(
+        workspace_ref,
+        "docs",
+        workspace.get("commit_sha"),
+        generate,
+        variant=data.doc_type
     )
 
-    return {"documentation": response.choices[0].message.content}
+    return {"documentation": documentation}
 
 # ================================
 # EDGE CASE PROMPT
@@ -994,29 +5354,24 @@ def build_edge_case_prompt(code: str, language: str):
     return f"""
 You are a strict QA engineer.
 
-Return ONLY valid JSON.
+Return ONLY a JSON object matching this JSON Schema:
+
+{json.dumps(EDGE_CASE_SCHEMA, indent=2)}
+
 Do NOT include explanations.
 Do NOT include markdown.
 Do NOT include backticks.
 
-Return strictly in this format:
-
-{{
-  "edge_test_cases": [
-    {{
-      "input": {{ }},
-      "expected_behavior": ""
-    }}
-  ]
-}}
-
 Rules:
 - Minimum 5 test cases
 - Include runtime error cases
 - Include boundary values
 - Include invalid input types
 - Include extreme values
-- Ensure JSON is valid
+- If the code defines a function, "input" is an object mapping its parameter names to argument values
+- Otherwise "input" is the text fed to the program on stdin
+
+Language: {language}
 
 Code:
 {code}
@@ -1027,7 +5382,10 @@ Code:
 # EDGE CASE ENDPOINT (FIXED)
 # ================================
 
-@app.post("/edge-cases")
+EDGE_CASE_ITEM_SCHEMA = EDGE_CASE_SCHEMA["properties"]["edge_test_cases"]["items"]
+
+
+@app.post("/edge-cases", dependencies=[Depends(admit_llm)])
 def generate_edge_cases(request: EdgeCaseRequest):
 
     if not request.code.strip():
@@ -1036,45 +5394,77 @@ def generate_edge_cases(request: EdgeCaseRequest):
     if request.language.lower() not in SUPPORTED_LANGUAGES:
         raise HTTPException(status_code=400, detail="Unsupported language")
 
-    prompt = build_edge_case_prompt(request.code, request.language)
+    code = compact_code("edge_cases", request.code, request.language)
+    prompt = build_edge_case_prompt(code, request.language)
 
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
+    raw = call_llm(
+        "edge_cases",
+        prompt,
+        input_text=code,
+        validate=is_schema_output(EDGE_CASE_SCHEMA),
+        response_format={"type": "json_object"},
         temperature=0,
-        max_tokens=1200
-    )
-
-    raw = response.choices[0].message.content.strip()
-
-    # Remove markdown completely
-    raw = raw.replace("```json", "").replace("```", "").strip()
+        max_tokens=output_budget("edge_cases", code)
+    ).strip()
 
-    # Extract JSON safely
-    match = re.search(r"\{[\s\S]*\}", raw)
+    parsed = repair_json(raw)
 
-    if not match:
+    if not isinstance(parsed, dict):
         return {
             "edge_test_cases": [],
             "error": "Model did not return valid JSON",
             "debug_output": raw
         }
 
-    try:
-        parsed = json.loads(match.group())
-
-        if "edge_test_cases" not in parsed:
-            return {
-                "edge_test_cases": [],
-                "error": "Missing edge_test_cases key",
-                "debug_output": raw
-            }
-
-        return parsed
-
-    except Exception as e:
+    if not isinstance(parsed.get("edge_test_cases"), list):
         return {
             "edge_test_cases": [],
-            "error": "JSON parsing failed",
+            "error": "Missing edge_test_cases key",
             "debug_output": raw
         }
+
+    # A truncated response can leave a half-written last case behind
+    parsed["edge_test_cases"] = [
+        case for case in parsed["edge_test_cases"]
+        if matches_schema(case, EDGE_CASE_ITEM_SCHEMA)
+    ]
+
+    return parsed
+
+
+@app.post("/edge-cases/stream", dependencies=[Depends(admit_llm)])
+def generate_edge_cases_stream(request: EdgeCaseRequest):
+    """
+    Server-sent events: one `case` event per test case as soon as the
+    model finishes it, then a `done` event with the full list.
+    """
+
+    if not request.code.strip():
+        raise HTTPException(status_code=400, detail="Code cannot be empty")
+
+    if request.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+
+    code = compact_code("edge_cases", request.code, request.language)
+    prompt = build_edge_case_prompt(code, request.language)
+
+    def events():
+        parser = IncrementalJSONParser()
+        cases = []
+
+        for chunk in stream_llm(
+            "edge_cases",
+            prompt,
+            input_text=code,
+            response_format={"type": "json_object"},
+            temperature=0,
+            max_tokens=output_budget("edge_cases", code)
+        ):
+            for kind, key, value in parser.feed(chunk):
+                if kind == "item" and key == "edge_test_cases" and matches_schema(value, EDGE_CASE_ITEM_SCHEMA):
+                    cases.append(value)
+                    yield sse_event("case", value)
+
+        yield sse_event("done", {"edge_test_cases": cases})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
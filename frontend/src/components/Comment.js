@@ -1,12 +1,11 @@
 import React, { useContext, useState } from "react";
 import Sidebar from "./Sidebar";
 import { CodeContext } from "./CodeContext";
+import { editorSession } from "./EditorSession";
 import Editor from "@monaco-editor/react";
 import { FiCopy, FiCheck } from "react-icons/fi";
 import "./Dashboard.css";
 
-const API = "http://127.0.0.1:8000";
-
 function Comment() {
   const { code, setCode } = useContext(CodeContext);
 
@@ -24,24 +23,14 @@ function Comment() {
     try {
       setLoading(true);
 
-      const res = await fetch(`${API}/comment`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({
-          code,
-          language,
-        }),
-      });
-
-      const data = await res.json();
-      setOutput(data.commented_code);
+      const data = await editorSession.run("comment", { code, language });
+      if (!data) return; // superseded by a newer request
 
+      setOutput(data.commented_code);
+      setLoading(false);
     } catch (error) {
       console.error("Comment generation error:", error);
       alert("Comment generation failed.");
-    } finally {
       setLoading(false);
     }
   };
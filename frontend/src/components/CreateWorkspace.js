@@ -49,7 +49,21 @@ function CreateWorkspace() {
         }),
       });
 
-      const data = await res.json();
+      const { job_id } = await res.json();
+
+      // Ingestion runs in the background; poll until it finishes
+      let job;
+      do {
+        await new Promise((resolve) => setTimeout(resolve, 1500));
+        const jobRes = await fetch(`${API}/jobs/${job_id}`);
+        job = await jobRes.json();
+      } while (job.status === "queued" || job.status === "running");
+
+      if (job.status !== "completed") {
+        throw new Error(job.error || `Workspace creation ${job.status}`);
+      }
+
+      const data = job.result;
 
       const newWorkspace = {
         id: data.workspace_id,
@@ -1,12 +1,11 @@
 import React, { useContext, useState } from "react";
 import Sidebar from "./Sidebar";
 import { CodeContext } from "./CodeContext";
+import { editorSession } from "./EditorSession";
 import Editor from "@monaco-editor/react";
 import { FiCopy, FiCheck } from "react-icons/fi";
 import "./Dashboard.css";
 
-const API = "http://127.0.0.1:8000";
-
 function Debug() {
   const { code, setCode } = useContext(CodeContext);
 
@@ -36,16 +35,8 @@ function Debug() {
     try {
       setLoading(true);
 
-      const res = await fetch(`${API}/debug`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          code,
-          language,
-        }),
-      });
-
-      const data = await res.json();
+      const data = await editorSession.run("debug", { code, language });
+      if (!data) return; // superseded by a newer debug run
 
       if (data.message) {
         setOutput(data.message);
@@ -54,10 +45,11 @@ function Debug() {
       } else {
         setOutput("Unexpected response from server.");
       }
+
+      setLoading(false);
     } catch (error) {
       console.error("Debug error:", error);
       alert("Debugging failed.");
-    } finally {
       setLoading(false);
     }
   };
@@ -0,0 +1,76 @@
+import { auth } from "../firebase";
+
+const WS_URL = "ws://127.0.0.1:8000/ws/editor";
+
+// One WebSocket shared by every editor action. Starting an action of the
+// same kind supersedes the previous one; the server cancels it and the
+// superseded promise resolves with null.
+export class EditorSession {
+  constructor() {
+    this.socket = null;
+    this.ready = null;
+    this.pending = new Map();
+    this.nextId = 1;
+  }
+
+  connect() {
+    if (this.ready) return this.ready;
+
+    // The server keys quotas on the verified ID token, not a claimed uid
+    const user = auth.currentUser;
+    const token = user ? user.getIdToken() : Promise.resolve(null);
+
+    this.ready = token.then((idToken) => new Promise((resolve, reject) => {
+      const url = idToken ? `${WS_URL}?token=${encodeURIComponent(idToken)}` : WS_URL;
+      const socket = new WebSocket(url);
+
+      socket.onopen = () => resolve(socket);
+      socket.onerror = () => reject(new Error("Editor session failed to connect"));
+      socket.onmessage = (message) => this.dispatch(JSON.parse(message.data));
+      socket.onclose = () => {
+        this.socket = null;
+        this.ready = null;
+        this.pending.forEach(({ reject: fail }) => fail(new Error("Editor session closed")));
+        this.pending.clear();
+      };
+
+      this.socket = socket;
+    }));
+
+    this.ready.catch(() => {
+      this.ready = null;
+    });
+
+    return this.ready;
+  }
+
+  dispatch({ id, event, data }) {
+    const operation = this.pending.get(id);
+    if (!operation) return;
+
+    if (event === "result") {
+      this.pending.delete(id);
+      operation.resolve(data);
+    } else if (event === "cancelled") {
+      this.pending.delete(id);
+      operation.resolve(null);
+    } else if (event === "error") {
+      this.pending.delete(id);
+      operation.reject(new Error(data.detail));
+    } else if (operation.onEvent) {
+      operation.onEvent(event, data);
+    }
+  }
+
+  async run(op, payload, onEvent) {
+    const socket = await this.connect();
+    const id = `${op}-${this.nextId++}`;
+
+    return new Promise((resolve, reject) => {
+      this.pending.set(id, { resolve, reject, onEvent });
+      socket.send(JSON.stringify({ id, op, payload }));
+    });
+  }
+}
+
+export const editorSession = new EditorSession();
@@ -34,17 +34,32 @@ function Generate() {
     try {
       setLoading(true);
 
-      const res = await fetch(`${API}/generate`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          message: instruction,
-          language: language,
-          history: currentCode
-            ? [{ role: "assistant", content: currentCode }]
-            : [],
-        }),
-      });
+      // The server session holds the latest version only; continuing from
+      // an earlier version (or after the session expired) resends the code
+      const history = currentCode
+        ? [{ role: "assistant", content: currentCode }]
+        : [];
+      const isLatest = currentIndex === versions.length - 1;
+      const sessionId = isLatest ? currentVersion.sessionId : null;
+
+      const post = (body) =>
+        fetch(`${API}/generate`, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({
+            message: instruction,
+            language: language,
+            ...body,
+          }),
+        });
+
+      let res = sessionId
+        ? await post({ session_id: sessionId })
+        : await post({ history });
+
+      if (res.status === 404 && sessionId) {
+        res = await post({ history });
+      }
 
       const data = await res.json();
       let newCode = data.code || "";
@@ -58,6 +73,7 @@ function Generate() {
       const newVersion = {
         prompt: instruction,
         code: newCode,
+        sessionId: data.session_id,
       };
 
       setVersions((prev) => {
@@ -14,6 +14,8 @@ function Optimize() {
   const [result, setResult] = useState(null);
   const [loading, setLoading] = useState(false);
   const [copied, setCopied] = useState(false);
+  const [verification, setVerification] = useState(null);
+  const [verifying, setVerifying] = useState(false);
 
   const handleCopy = async () => {
     if (!result?.optimized_code) return;
@@ -44,6 +46,7 @@ function Optimize() {
 
       const data = await res.json();
       setResult(data);
+      setVerification(null);
     } catch (error) {
       console.error("Optimize error:", error);
       alert("Optimization failed.");
@@ -52,6 +55,36 @@ function Optimize() {
     }
   };
 
+  // Runs both versions on generated inputs and measures the real speedup
+  const handleVerify = async () => {
+    if (!result?.optimized_code) return;
+
+    try {
+      setVerifying(true);
+
+      const res = await fetch(`${API}/optimize/verify`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          code,
+          language,
+          optimized_code: result.optimized_code,
+          before_time_complexity: result.before_time_complexity,
+          after_time_complexity: result.after_time_complexity,
+        }),
+      });
+
+      const data = await res.json();
+      if (!res.ok) throw new Error(data.detail);
+      setVerification(data);
+    } catch (error) {
+      console.error("Verify error:", error);
+      alert("Verification failed.");
+    } finally {
+      setVerifying(false);
+    }
+  };
+
   const headerStyle = {
     display: "flex",
     justifyContent: "space-between",
@@ -204,6 +237,12 @@ function Optimize() {
                 <p>
                   <strong>Space Complexity:</strong> {result.before_space_complexity}
                 </p>
+                {verification && (
+                  <p>
+                    <strong>Measured:</strong>{" "}
+                    {verification.original.empirical_time_complexity || verification.original.fit.reason}
+                  </p>
+                )}
               </div>
 
               <div className="complexity-box after-box">
@@ -214,10 +253,39 @@ function Optimize() {
                 <p>
                   <strong>Space Complexity:</strong> {result.after_space_complexity}
                 </p>
+                {verification && (
+                  <p>
+                    <strong>Measured:</strong>{" "}
+                    {verification.optimized.empirical_time_complexity || verification.optimized.fit.reason}
+                  </p>
+                )}
               </div>
 
             </div>
 
+            <button className="action-btn" onClick={handleVerify}>
+              {verifying ? "Verifying..." : "Verify Optimization"}
+            </button>
+
+            {verification && (
+              <div className="explanation-card" style={{ marginTop: "20px" }}>
+                <p>
+                  <strong>Outputs equivalent:</strong>{" "}
+                  {verification.equivalent === null
+                    ? "Not compared"
+                    : verification.equivalent
+                    ? `Yes (${verification.compared_sizes} input sizes)`
+                    : `No, differs at n=${verification.mismatch.size}`}
+                </p>
+                <p>
+                  <strong>Measured speedup:</strong>{" "}
+                  {verification.speedup
+                    ? `${verification.speedup}x at n=${verification.speedup_at_size}`
+                    : "Not measured"}
+                </p>
+              </div>
+            )}
+
           </div>
         )}
 
@@ -1,12 +1,11 @@
 import React, { useContext, useState } from "react";
 import Sidebar from "./Sidebar";
 import { CodeContext } from "./CodeContext";
+import { editorSession } from "./EditorSession";
 import Editor from "@monaco-editor/react";
 import { FiCopy, FiCheck } from "react-icons/fi";
 import "./Dashboard.css";
 
-const API = "http://127.0.0.1:8000";
-
 function Review() {
   const { code, setCode } = useContext(CodeContext);
 
@@ -50,21 +49,14 @@ ${review.low || ""}
     try {
       setLoading(true);
 
-      const res = await fetch(`${API}/review`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          code,
-          language,
-        }),
-      });
+      const data = await editorSession.run("review", { code, language });
+      if (!data) return; // superseded by a newer review
 
-      const data = await res.json();
       setReview(data.structured_review);
+      setLoading(false);
     } catch (error) {
       console.error("Review error:", error);
       alert("Review failed.");
-    } finally {
       setLoading(false);
     }
   };
@@ -1,6 +1,7 @@
 import React, { useContext, useState } from "react";
 import Sidebar from "./Sidebar";
 import { CodeContext } from "./CodeContext";
+import { editorSession } from "./EditorSession";
 import Editor from "@monaco-editor/react";
 import { FiCopy, FiCheck } from "react-icons/fi";
 import "./Dashboard.css";
@@ -21,7 +22,7 @@ function Test() {
   // ==========================
   // RUN CODE
   // ==========================
-  const handleRun = async () => {
+  const handleRun = async (profile = false) => {
     if (!code.trim()) {
       alert("Please enter code first.");
       return;
@@ -30,24 +31,25 @@ function Test() {
     try {
       setLoading(true);
       setShowOutput(true);
+      setResult({ output: "", error: "" });
 
-      const res = await fetch(`${API}/run`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({
-          code,
-          language,
-        }),
+      // Output streams in; a newer run kills this one on the server
+      const data = await editorSession.run("run", { code, language, profile }, (event, chunk) => {
+        const key = event === "stdout" ? "output" : "error";
+        setResult((prev) => ({ ...prev, [key]: prev[key] + chunk.text }));
       });
-
-      const data = await res.json();
-      setResult(data);
+      if (!data) return;
+
+      if (data.timed_out) {
+        setResult((prev) => ({ ...prev, error: "Execution timed out." }));
+      }
+      if (profile) {
+        setResult((prev) => ({ ...prev, metrics: data.metrics, profile: data.profile }));
+      }
+      setLoading(false);
     } catch (error) {
       console.error("Execution error:", error);
       alert("Execution failed.");
-    } finally {
       setLoading(false);
     }
   };
@@ -119,13 +121,31 @@ ${result.error || ""}
     fontSize: "14px",
   };
 
+  const metricsText = result.metrics
+    ? `
+METRICS:
+Wall time: ${result.metrics.wall_ms} ms
+CPU time: ${result.metrics.cpu_ms} ms
+Peak memory: ${result.metrics.peak_rss_kb ?? "n/a"} KB
+`
+    : "";
+
+  const profileText = result.profile
+    ? `
+PROFILE (${result.profile.profiler}, by self time):
+${result.profile.entries
+  .map((entry) => `${entry.self_ms} ms self, ${entry.total_ms} ms total  ${entry.function}  ${entry.location}`)
+  .join("\n")}
+`
+    : "";
+
   const outputText = `
 OUTPUT:
 ${result.output || "No output"}
 
 ERROR:
 ${result.error || "No errors"}
-`;
+${metricsText}${profileText}`;
 
   return (
     <div className="dashboard-container">
@@ -178,10 +198,14 @@ ${result.error || "No errors"}
 
         {/* Buttons */}
         <div style={{ display: "flex", gap: "15px", marginTop: "20px" }}>
-          <button className="action-btn" onClick={handleRun}>
+          <button className="action-btn" onClick={() => handleRun()}>
             {loading ? "Running..." : "Run Code"}
           </button>
 
+          <button className="action-btn" onClick={() => handleRun(true)}>
+            Run with Profile
+          </button>
+
           <button className="action-btn" onClick={handleEdgeCases}>
             {edgeLoading ? "Generating..." : "Generate Edge Cases"}
           </button>
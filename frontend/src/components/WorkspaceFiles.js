@@ -40,7 +40,7 @@ function WorkspaceFiles() {
       const res = await fetch(
         `${API}/workspace/file-content?download_url=${encodeURIComponent(
           file.download_url
-        )}`
+        )}${file.blob_sha ? `&blob_sha=${file.blob_sha}` : ""}`
       );
       const data = await res.json();
       setFileContent(data.content);